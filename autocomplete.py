@@ -0,0 +1,246 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import re
+import logging
+from bisect import bisect_left, insort
+from datetime import datetime
+
+from gi.repository import GObject
+
+import places
+
+_index = None
+
+_SCHEME_RE = re.compile(r'^[a-z][a-z0-9+.-]*://(www\.)?')
+
+# Separates the key from the uri in the entries of the index.
+_SEPARATOR = u'\0'
+
+
+def _normalize_uri(uri):
+    """Return uri in lower case without its scheme and 'www.'."""
+    return _SCHEME_RE.sub('', uri.lower())
+
+
+def _get_keys(uri, title):
+    """Return the prefixes under which a place can be found."""
+    uri = _normalize_uri(uri)
+    keys = [uri]
+    # Also without the first label of the host, so that 'wiki' finds
+    # en.wikipedia.org, as the domain of places does.
+    host = uri.split('/', 1)[0]
+    if host.count('.') >= 2:
+        keys.append(uri[host.index('.') + 1:])
+    keys.extend(title.lower().split())
+    return keys
+
+
+class PrefixIndex(object):
+    """In-memory index answering URL entry prefix queries.
+
+    The index is a sorted list of 'key\\0uri' strings, where the keys
+    are the uri without scheme and 'www.', the same without the first
+    label of the host and the words of the title.
+    All the entries for a prefix are found next to each other with a
+    binary search.  The places are loaded from the store in small
+    steps from idle callbacks, the entries being sorted once all are
+    loaded, and kept up to date by the signals of the store.  If the
+    history has more than MAX_PLACES places the index is dropped, and
+    search() returns None so the caller uses SqliteStore.search()
+    instead.
+    """
+
+    MAX_PLACES = 20000
+    MAX_CANDIDATES = 200
+    LOAD_CHUNK = 500
+
+    def __init__(self):
+        self._store = places.get_store()
+        self._entries = []
+        self._places = {}
+        self._ready = False
+        self._enabled = True
+        self._last_rowid = 0
+        self._load_sid = None
+
+        self._store.connect('visit-added', self.__visit_added_cb)
+        self._store.connect('title-changed', self.__title_changed_cb)
+        self._store.connect('places-expired', self.__places_expired_cb)
+
+    def __visit_added_cb(self, store, visits):
+        for uri, visit_type in visits:
+            self.add_visit(uri, visit_type)
+
+    def __title_changed_cb(self, store, titles):
+        for uri, title in titles:
+            self.set_title(uri, title)
+
+    def __places_expired_cb(self, store, uris):
+        self.remove(uris)
+
+    def load(self):
+        """Start loading the history in the background."""
+        if self._load_sid is not None or self._ready:
+            return
+
+        if self._store.count_places() > self.MAX_PLACES:
+            logging.debug('History too large for the autocomplete index')
+            self._disable()
+            return
+
+        self._load_sid = GObject.idle_add(self.__load_idle_cb,
+                                          priority=GObject.PRIORITY_LOW)
+
+    def __load_idle_cb(self):
+        if not self._enabled:
+            self._load_sid = None
+            return False
+
+        rows = self._store.get_places(self._last_rowid, self.LOAD_CHUNK)
+        for rowid, place in rows:
+            self._add(place.uri, place.title, place.frecency)
+            self._last_rowid = rowid
+
+        if len(rows) == self.LOAD_CHUNK:
+            return True
+
+        # The entries are only kept sorted once loaded, sorting them
+        # once is much faster than inserting them one by one.
+        self._entries.sort()
+        self._load_sid = None
+        self._ready = True
+        logging.debug('Autocomplete index loaded with %d places',
+                      len(self._places))
+        return False
+
+    def _disable(self):
+        self._enabled = False
+        self._ready = False
+        self._entries = []
+        self._places = {}
+
+    def _add(self, uri, title, frecency):
+        if not self._enabled or not uri:
+            return
+
+        if uri in self._places:
+            self._remove_keys(uri)
+        elif len(self._places) >= self.MAX_PLACES:
+            logging.debug('History too large for the autocomplete index')
+            self._disable()
+            return
+
+        title = title or ''
+        self._places[uri] = [title, frecency]
+        for key in _get_keys(uri, title):
+            if self._ready:
+                insort(self._entries, key + _SEPARATOR + uri)
+            else:
+                self._entries.append(key + _SEPARATOR + uri)
+
+    def _remove_keys(self, uri):
+        title = self._places[uri][0]
+        for key in _get_keys(uri, title):
+            entry = key + _SEPARATOR + uri
+            if not self._ready:
+                if entry in self._entries:
+                    self._entries.remove(entry)
+                continue
+            position = bisect_left(self._entries, entry)
+            if position < len(self._entries) and \
+                    self._entries[position] == entry:
+                del self._entries[position]
+
+    def add_visit(self, uri, visit_type=places.VISIT_LINK):
+        boost = places.frecency_boost(datetime.now(), visit_type)
+        if uri in self._places:
+            self._places[uri][1] += boost
+        else:
+            self._add(uri, '', boost)
+
+    def set_title(self, uri, title):
+        if uri in self._places:
+            self._add(uri, title, self._places[uri][1])
+
+    def remove(self, uris):
+        for uri in uris:
+            if uri in self._places:
+                self._remove_keys(uri)
+                del self._places[uri]
+
+    def search(self, text):
+        """Return the best places matching text, as a list of Place.
+
+        Every word of the text has to be a prefix of the uri or of a
+        word of the title.  The best place of each host comes first,
+        see places.group_by_host().  Return None when the index can't
+        answer.
+        """
+        if not self._ready:
+            return None
+
+        words = _normalize_uri(text).split()
+        if not words:
+            return []
+
+        # Look up the longest word, usually the one matching less
+        # places, and check the others on the places found.
+        prefix = max(words, key=len)
+        words.remove(prefix)
+        uris = set()
+        position = bisect_left(self._entries, prefix)
+        while position < len(self._entries):
+            entry = self._entries[position]
+            if not entry.startswith(prefix):
+                break
+            uris.add(entry[entry.index(_SEPARATOR) + 1:])
+            if len(uris) > self.MAX_CANDIDATES:
+                return None
+            position += 1
+
+        if words:
+            uris = [uri for uri in uris if self._matches(uri, words)]
+
+        result = []
+        for uri in sorted(uris, key=self._get_rank, reverse=True):
+            title, frecency = self._places[uri]
+            result.append(places.Place(uri, title, frecency=frecency))
+        return places.group_by_host(result, self._store.MAX_SEARCH_MATCHES)
+
+    def _get_rank(self, uri):
+        frecency = self._places[uri][1]
+        if self._store.is_bookmarked(uri):
+            return frecency * self._store.BOOKMARK_BOOST
+        return frecency
+
+    def _matches(self, uri, words):
+        keys = _get_keys(uri, self._places[uri][0])
+        for word in words:
+            for key in keys:
+                if key.startswith(word):
+                    break
+            else:
+                return False
+        return True
+
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = PrefixIndex()
+        _index.load()
+    return _index
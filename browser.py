@@ -37,6 +37,8 @@ from widgets import BrowserNotebook
 from palettes import ContentInvoker
 from filepicker import FilePicker
 import globalhistory
+import pageindex
+import places
 import downloadmanager
 from pdfviewer import PDFTabPage
 
@@ -554,8 +556,19 @@ class Browser(WebKit.WebView):
 
         self.security_status = None
 
+        # Why the main frame is navigating, to weight the visit in the
+        # global history.
+        self._navigation_reason = None
+
+        # Set when the user presses Enter on the URL Entry, so the next
+        # main frame navigation is recorded as typed.
+        self.typed_navigation = False
+        self._navigation_typed = False
+
         # Reference to the global history and callbacks to handle it:
         self._global_history = globalhistory.get_global_history()
+        self.connect('navigation-policy-decision-requested',
+                     self.__navigation_policy_cb)
         self.connect('notify::load-status', self.__load_status_changed_cb)
         self.connect('notify::title', self.__title_changed_cb)
         self.connect('download-requested', self.__download_requested_cb)
@@ -658,12 +671,41 @@ class Browser(WebKit.WebView):
             request.cancel()
         return True
 
+    def __navigation_policy_cb(self, webview, frame, request, action,
+                               policy_decision):
+        if frame == self.get_main_frame():
+            self._navigation_reason = action.get_reason()
+            self._navigation_typed = self.typed_navigation
+            self.typed_navigation = False
+        # Let WebKit take the decision.
+        return False
+
+    def _get_visit_type(self, uri):
+        if self._navigation_reason == WebKit.WebNavigationReason.RELOAD:
+            return places.VISIT_RELOAD
+        elif self._navigation_reason in (
+                WebKit.WebNavigationReason.LINK_CLICKED,
+                WebKit.WebNavigationReason.FORM_SUBMITTED):
+            return places.VISIT_LINK
+        elif self._navigation_typed:
+            return places.VISIT_TYPED
+        return places.VISIT_LINK
+
     def __load_status_changed_cb(self, widget, param):
         status = widget.get_load_status()
-        if status <= WebKit.LoadStatus.COMMITTED:
-            # Add the url to the global history or update it.
+        if status == WebKit.LoadStatus.COMMITTED:
+            # Add the url to the global history or update it.  Before
+            # the load is committed the uri is still the one of the
+            # page being left.
             uri = self.get_uri()
-            self._global_history.add_page(uri)
+            if uri is not None:
+                self._global_history.add_page(uri,
+                                              self._get_visit_type(uri))
+
+        if status == WebKit.LoadStatus.FINISHED:
+            page_index = pageindex.get_page_index()
+            if page_index is not None:
+                self._index_page(page_index)
 
         if status == WebKit.LoadStatus.COMMITTED:
             # Update the security status.
@@ -681,6 +723,15 @@ class Browser(WebKit.WebView):
                     self.security_status = None
                 self.emit('security-status-changed')
 
+    def _index_page(self, page_index):
+        document = self.get_dom_document()
+        if document is None:
+            return
+        body = document.get_body()
+        if body is None:
+            return
+        page_index.add_page(self.get_uri(), body.get_inner_text())
+
     def __title_changed_cb(self, widget, param):
         """Update title in global history."""
         uri = self.get_uri()
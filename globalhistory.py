@@ -14,36 +14,182 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-from datetime import datetime
+import os
+import copy
+import time
+from collections import OrderedDict
+
+from gi.repository import GObject
 
 import places
+import autocomplete
+import historyservice
 
 _global_history = None
 
+# Set BROWSE_HISTORY_SERVICE=1 to share one history between all the
+# running Browse instances, see historyservice.py.
+_USE_SERVICE = os.environ.get('BROWSE_HISTORY_SERVICE') == '1'
+
+
+class GlobalHistory(GObject.GObject):
+    """The history of this Browse instance, backed by places.db.
+
+    It repeats the signals of places.SqliteStore.  The places last
+    visited or looked up, up to MAX_CACHED_PLACES, are kept in memory
+    and updated with the visits and titles written through this
+    object.  So set_page_title() drops the titles a page already has,
+    and get_place() doesn't have to wait for the store to read them.
+    A place cached by a visit only knows its title until get_place()
+    reads the rest.
+    """
+
+    __gsignals__ = dict(places.SqliteStore.__gsignals__)
+
+    MAX_CACHED_PLACES = 100
 
-class GlobalHistory(object):
     def __init__(self):
+        GObject.GObject.__init__(self)
         self._store = places.get_store()
+        self._index = autocomplete.get_index()
+        # Places by uri, least recently used first.  None stands for
+        # a uri not in the history.
+        self._places = OrderedDict()
 
-    def add_page(self, uri):
-        place = self._store.lookup_place(uri)
-        if place:
-            place.visits += 1
-            place.last_visit = datetime.now()
-            self._store.update_place(place)
+        for signal in places.SqliteStore.SIGNALS:
+            self._store.connect(signal, self.__store_changed_cb, signal)
+        self._store.connect('bookmark-changed', self.__bookmark_changed_cb)
+        self._store.connect('places-expired', self.__places_expired_cb)
+
+    def __store_changed_cb(self, store, changes, signal):
+        self.emit(signal, changes)
+
+    def __bookmark_changed_cb(self, store, bookmarks):
+        for uri, bookmarked in bookmarks:
+            if uri in self._places:
+                if self._places[uri] is None:
+                    # Bookmarking adds the place.
+                    del self._places[uri]
+                else:
+                    self._places[uri].bookmark = bookmarked
+
+    def __places_expired_cb(self, store, uris):
+        for uri in uris:
+            self._places.pop(uri, None)
+
+    def _get_cached(self, uri):
+        place = self._places.pop(uri)
+        self._places[uri] = place
+        return place
+
+    def _cache(self, uri, place):
+        self._places.pop(uri, None)
+        self._places[uri] = place
+        if len(self._places) > self.MAX_CACHED_PLACES:
+            self._places.popitem(last=False)
+
+    def add_page(self, uri, visit_type=places.VISIT_LINK):
+        self._store.record_visit(uri, visit_type=visit_type)
+
+        now = int(time.time())
+        if uri not in self._places:
+            # Its title is written by set_page_title(), the counts are
+            # unknown until get_place().
+            self._cache(uri, places.Place(uri, title=None, visits=None,
+                                          last_visit=now))
+            return
+
+        # Count the visit as the store does.
+        boost = places.frecency_boost(now, visit_type)
+        place = self._get_cached(uri)
+        if place is None:
+            self._cache(uri, places.Place(uri, last_visit=now,
+                                          frecency=boost))
+        elif place.visits is None:
+            place.last_visit = now
         else:
-            place = places.Place(uri)
-            self._store.add_place(place)
+            place.visits += 1
+            place.last_visit = now
+            place.frecency = (place.frecency or 0) + boost
 
     def set_page_title(self, uri, title):
+        if uri in self._places:
+            place = self._get_cached(uri)
+            if place is not None:
+                if place.title == title:
+                    return
+                place.title = title
+
+        self._store.set_title(uri, title)
+
+    def get_place(self, uri):
+        """Return the Place of uri, or None if it was never visited."""
+        if uri in self._places:
+            place = self._get_cached(uri)
+            if place is None or place.visits is not None:
+                return copy.copy(place)
+
         place = self._store.lookup_place(uri)
-        if place:
-            place.title = title
-            self._store.update_place(place)
+        self._cache(uri, place)
+        return copy.copy(place)
+
+    def search(self, text, callback, client=None):
+        """Pass the places matching text to callback(places).
+
+        The in-memory index answers typed prefixes right away, the
+        store also finds words in the middle of addresses.  A search
+        replaces the one of the same client in flight, see
+        SqliteStore.search_async().
+        """
+        matches = self._index.search(text)
+        if matches:
+            self._store.cancel_search(client)
+            callback(matches)
+        else:
+            self._store.search_async(text, callback, client)
+
+    def find_places(self, text):
+        """Return the places matching text, searching in this thread."""
+        matches = self._index.search(text)
+        if not matches:
+            matches = self._store.search(text)
+        return matches
+
+    def cancel_search(self, client=None):
+        self._store.cancel_search(client)
+
+    def forget_search_client(self, client):
+        self._store.forget_search_client(client)
+
+    def add_bookmark(self, uri, title=''):
+        self._store.add_bookmark(uri, title)
+
+    def remove_bookmark(self, uri):
+        self._store.remove_bookmark(uri)
+
+    def is_bookmarked(self, uri):
+        return self._store.is_bookmarked(uri)
+
+    def get_bookmarks(self):
+        return self._store.get_bookmarks()
+
+    def flush(self):
+        self._store.flush()
+
+    def expire(self):
+        """Remove old pages from the history in the background."""
+        self._store.start_expiry()
+
+    def maintain(self):
+        """Tidy up places.db in the background, when it is due."""
+        self._store.start_maintenance()
 
 
 def get_global_history():
     global _global_history
     if _global_history is None:
-        _global_history = GlobalHistory()
+        if _USE_SERVICE:
+            _global_history = historyservice.get_history(GlobalHistory)
+        else:
+            _global_history = GlobalHistory()
     return _global_history
@@ -0,0 +1,411 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""One history shared by all the running Browse instances.
+
+The first instance owns places.db and serves its GlobalHistory on the
+session bus.  The instances started later talk to it through a
+RemoteHistory, so they don't open places.db and their URL entry uses
+the autocomplete index already loaded by the first one.
+"""
+
+import time
+import logging
+import functools
+
+import dbus
+import dbus.service
+from gi.repository import GObject
+
+import places
+
+SERVICE = 'org.laptop.WebActivity.History'
+IFACE = SERVICE
+PATH = '/org/laptop/WebActivity/History'
+
+# A place on the bus: uri, title, bookmark, visits, last visit in
+# seconds since the epoch and frecency.
+_PLACE = '(ssbuxd)'
+_NO_PLACE = ('', '', False, 0, 0, 0.0)
+
+_logger = logging.getLogger('historyservice')
+
+_service = None
+
+
+def _place_to_struct(place):
+    last_visit = int(time.mktime(place.last_visit.timetuple()))
+    return (place.uri, place.title or '', bool(place.bookmark),
+            place.visits or 0, last_visit, place.frecency or 0.0)
+
+
+def _struct_to_place(struct):
+    uri, title, bookmark, visits, last_visit, frecency = struct
+    return places.Place(unicode(uri), unicode(title), bool(bookmark),
+                        visits=int(visits), last_visit=int(last_visit),
+                        frecency=float(frecency))
+
+
+def _claim_name(bus):
+    """Return the BusName of the service, or None if already taken."""
+    try:
+        return dbus.service.BusName(SERVICE, bus, do_not_queue=True)
+    except dbus.exceptions.NameExistsException:
+        return None
+
+
+class HistoryService(dbus.service.Object):
+    """Serve a GlobalHistory to the other Browse instances."""
+
+    def __init__(self, history, bus_name):
+        dbus.service.Object.__init__(self, bus_name, PATH)
+        self._history = history
+        self._bus_name = bus_name
+        # The reply of the Search call in flight, by sender.
+        self._search_replies = {}
+        # The watches of the senders that searched.
+        self._senders = {}
+        history.connect('visit-added', self.__visit_added_cb)
+        history.connect('title-changed', self.__title_changed_cb)
+        history.connect('bookmark-changed', self.__bookmark_changed_cb)
+        history.connect('places-expired', self.__places_expired_cb)
+
+    def __visit_added_cb(self, history, visits):
+        self.VisitAdded(visits)
+
+    def __title_changed_cb(self, history, titles):
+        self.TitleChanged([(uri, title or '') for uri, title in titles])
+
+    def __bookmark_changed_cb(self, history, bookmarks):
+        self.BookmarkChanged(bookmarks)
+
+    def __places_expired_cb(self, history, uris):
+        self.PlacesExpired(uris)
+
+    @dbus.service.method(IFACE, in_signature='s',
+                         out_signature='a' + _PLACE,
+                         sender_keyword='sender',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def Search(self, text, sender, reply_cb, error_cb):
+        # Searched in a thread, one for each instance, so the main
+        # loop of this instance goes on.  A search replaced by a newer
+        # one of the same instance gets no places.
+        if sender in self._search_replies:
+            self._search_replies.pop(sender)([])
+        if sender not in self._senders:
+            self._senders[sender] = self._bus_name.get_bus(). \
+                watch_name_owner(sender, functools.partial(
+                    self.__sender_changed_cb, sender))
+        self._search_replies[sender] = reply_cb
+
+        def places_cb(found):
+            if self._search_replies.get(sender) is reply_cb:
+                del self._search_replies[sender]
+                reply_cb([_place_to_struct(place) for place in found])
+
+        self._history.search(text, places_cb, client=sender)
+
+    def __sender_changed_cb(self, sender, owner):
+        # The unique name of an instance loses its owner when the
+        # instance quits.
+        if owner or sender not in self._senders:
+            return
+        self._senders.pop(sender).remove()
+        self._search_replies.pop(sender, None)
+        self._history.forget_search_client(sender)
+
+    @dbus.service.method(IFACE, in_signature='s',
+                         out_signature='b' + _PLACE)
+    def LookupPlace(self, uri):
+        place = self._history.get_place(uri)
+        if place is None:
+            return False, _NO_PLACE
+        return True, _place_to_struct(place)
+
+    @dbus.service.method(IFACE, in_signature='si', out_signature='')
+    def RecordVisit(self, uri, visit_type):
+        self._history.add_page(uri, visit_type)
+
+    @dbus.service.method(IFACE, in_signature='ss', out_signature='')
+    def SetTitle(self, uri, title):
+        self._history.set_page_title(uri, title)
+
+    @dbus.service.method(IFACE, in_signature='ss', out_signature='')
+    def AddBookmark(self, uri, title):
+        self._history.add_bookmark(uri, title)
+
+    @dbus.service.method(IFACE, in_signature='s', out_signature='')
+    def RemoveBookmark(self, uri):
+        self._history.remove_bookmark(uri)
+
+    @dbus.service.method(IFACE, in_signature='',
+                         out_signature='a' + _PLACE)
+    def GetBookmarks(self):
+        return [_place_to_struct(place)
+                for place in self._history.get_bookmarks()]
+
+    @dbus.service.method(IFACE, in_signature='', out_signature='')
+    def Flush(self):
+        self._history.flush()
+
+    @dbus.service.signal(IFACE, signature='a(si)')
+    def VisitAdded(self, visits):
+        pass
+
+    @dbus.service.signal(IFACE, signature='a(ss)')
+    def TitleChanged(self, titles):
+        pass
+
+    @dbus.service.signal(IFACE, signature='a(sb)')
+    def BookmarkChanged(self, bookmarks):
+        pass
+
+    @dbus.service.signal(IFACE, signature='as')
+    def PlacesExpired(self, uris):
+        pass
+
+
+class RemoteHistory(GObject.GObject):
+    """The history served by another Browse instance.
+
+    It has the methods and the signals of GlobalHistory.  The
+    bookmarked uris are kept here, so is_bookmarked() doesn't go over
+    the bus.  When the serving instance quits, this one tries to serve
+    the history, if another instance does it first the calls go to
+    that one.
+    """
+
+    __gsignals__ = dict(places.SqliteStore.__gsignals__)
+
+    def __init__(self, bus, factory):
+        GObject.GObject.__init__(self)
+        self._bus = bus
+        self._factory = factory
+        self._local = None
+        self._owner = None
+        self._bookmarks = set()
+        self._search_serial = 0
+
+        self._proxy = dbus.Interface(
+            bus.get_object(SERVICE, PATH, follow_name_owner_changes=True),
+            IFACE)
+        for member, callback in [
+                ('VisitAdded', self.__visit_added_cb),
+                ('TitleChanged', self.__title_changed_cb),
+                ('BookmarkChanged', self.__bookmark_changed_cb),
+                ('PlacesExpired', self.__places_expired_cb)]:
+            bus.add_signal_receiver(callback, member, IFACE, SERVICE, PATH)
+        bus.watch_name_owner(SERVICE, self.__owner_changed_cb)
+
+    def __owner_changed_cb(self, owner):
+        if self._local is not None:
+            return
+
+        if owner:
+            if owner != self._owner:
+                self._owner = owner
+                self._load_bookmarks()
+            return
+
+        _logger.debug('The history service quit, taking over')
+        bus_name = _claim_name(self._bus)
+        if bus_name is None:
+            return
+
+        self._local = self._factory()
+        for signal in places.SqliteStore.SIGNALS:
+            self._local.connect(signal, self.__local_changed_cb, signal)
+        global _service
+        _service = HistoryService(self._local, bus_name)
+
+    def __local_changed_cb(self, history, changes, signal):
+        self.emit(signal, changes)
+
+    def _load_bookmarks(self):
+        self._proxy.GetBookmarks(reply_handler=self.__bookmarks_cb,
+                                 error_handler=self.__error_cb)
+
+    def __bookmarks_cb(self, structs):
+        self._bookmarks = set(unicode(struct[0]) for struct in structs)
+
+    # Once this instance serves the history, the signals come from
+    # its own GlobalHistory.
+
+    def __visit_added_cb(self, visits):
+        if self._local is None:
+            self.emit('visit-added', [(unicode(uri), int(visit_type))
+                                      for uri, visit_type in visits])
+
+    def __title_changed_cb(self, titles):
+        if self._local is None:
+            self.emit('title-changed', [(unicode(uri), unicode(title))
+                                        for uri, title in titles])
+
+    def __bookmark_changed_cb(self, bookmarks):
+        if self._local is not None:
+            return
+
+        bookmarks = [(unicode(uri), bool(bookmarked))
+                     for uri, bookmarked in bookmarks]
+        for uri, bookmarked in bookmarks:
+            if bookmarked:
+                self._bookmarks.add(uri)
+            else:
+                self._bookmarks.discard(uri)
+        self.emit('bookmark-changed', bookmarks)
+
+    def __places_expired_cb(self, uris):
+        if self._local is None:
+            self.emit('places-expired', [unicode(uri) for uri in uris])
+
+    def __reply_cb(self):
+        pass
+
+    def __error_cb(self, error):
+        _logger.error('History service call failed: %s', error)
+
+    def _call(self, method, *args):
+        # Writes don't wait for the reply, the bus keeps them in order.
+        getattr(self._proxy, method)(*args, reply_handler=self.__reply_cb,
+                                     error_handler=self.__error_cb)
+
+    def add_page(self, uri, visit_type=places.VISIT_LINK):
+        if self._local is not None:
+            self._local.add_page(uri, visit_type)
+        else:
+            self._call('RecordVisit', uri, visit_type)
+
+    def set_page_title(self, uri, title):
+        if self._local is not None:
+            self._local.set_page_title(uri, title)
+        else:
+            self._call('SetTitle', uri, title or '')
+
+    def get_place(self, uri):
+        if self._local is not None:
+            return self._local.get_place(uri)
+
+        try:
+            found, struct = self._proxy.LookupPlace(uri)
+        except dbus.DBusException as error:
+            self.__error_cb(error)
+            return None
+        if not found:
+            return None
+        return _struct_to_place(struct)
+
+    def search(self, text, callback):
+        if self._local is not None:
+            self._local.search(text, callback)
+            return
+
+        self._search_serial += 1
+        serial = self._search_serial
+
+        def reply_cb(structs):
+            # Drop the results of searches replaced or cancelled.
+            if serial == self._search_serial:
+                callback([_struct_to_place(struct) for struct in structs])
+
+        self._proxy.Search(text, reply_handler=reply_cb,
+                           error_handler=self.__error_cb)
+
+    def find_places(self, text):
+        if self._local is not None:
+            return self._local.find_places(text)
+
+        try:
+            structs = self._proxy.Search(text)
+        except dbus.DBusException as error:
+            self.__error_cb(error)
+            return []
+        return [_struct_to_place(struct) for struct in structs]
+
+    def cancel_search(self):
+        self._search_serial += 1
+        if self._local is not None:
+            self._local.cancel_search()
+
+    def add_bookmark(self, uri, title=''):
+        if self._local is not None:
+            self._local.add_bookmark(uri, title)
+        else:
+            self._call('AddBookmark', uri, title or '')
+            self._bookmarks.add(unicode(uri))
+
+    def remove_bookmark(self, uri):
+        if self._local is not None:
+            self._local.remove_bookmark(uri)
+        else:
+            self._call('RemoveBookmark', uri)
+            self._bookmarks.discard(unicode(uri))
+
+    def is_bookmarked(self, uri):
+        if self._local is not None:
+            return self._local.is_bookmarked(uri)
+        return unicode(uri) in self._bookmarks
+
+    def get_bookmarks(self):
+        if self._local is not None:
+            return self._local.get_bookmarks()
+
+        try:
+            structs = self._proxy.GetBookmarks()
+        except dbus.DBusException as error:
+            self.__error_cb(error)
+            return []
+        return [_struct_to_place(struct) for struct in structs]
+
+    def flush(self):
+        if self._local is not None:
+            self._local.flush()
+        else:
+            self._call('Flush')
+
+    def expire(self):
+        """Expire the history, when this instance serves it."""
+        if self._local is not None:
+            self._local.expire()
+
+    def maintain(self):
+        """Maintain the history, when this instance serves it."""
+        if self._local is not None:
+            self._local.maintain()
+
+
+def get_history(factory):
+    """Return the history shared by the running Browse instances.
+
+    The first instance serves the GlobalHistory made by factory() and
+    gets it back, the others get a RemoteHistory.  Without a session
+    bus every instance uses its own GlobalHistory.
+    """
+    global _service
+
+    try:
+        bus = dbus.SessionBus()
+        bus_name = _claim_name(bus)
+    except dbus.DBusException as error:
+        _logger.error('No history service: %s', error)
+        return factory()
+
+    if bus_name is None:
+        _logger.debug('Using the history of another instance')
+        return RemoteHistory(bus, factory)
+
+    history = factory()
+    _service = HistoryService(history, bus_name)
+    return history
@@ -0,0 +1,282 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Full-text index of the text of the visited pages.
+
+The text of a page is handed over by Browser once it is loaded, and
+written by a thread to pages.db, next to places.db.  The index is an
+FTS4 table storing the text compressed with zlib.
+"""
+
+import os
+import re
+import zlib
+import time
+import array
+import Queue
+import atexit
+import logging
+import sqlite3
+import threading
+
+from sugar3.activity import activity
+
+_page_index = None
+
+# Set BROWSE_PAGE_INDEX=1 to index the text of the visited pages.
+_USE_PAGE_INDEX = os.environ.get('BROWSE_PAGE_INDEX') == '1'
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _compress(text):
+    if text is None:
+        return None
+    return buffer(zlib.compress(text.encode('utf-8')))
+
+
+def _uncompress(data):
+    if data is None:
+        return None
+    return zlib.decompress(str(data)).decode('utf-8')
+
+
+def _rank(matchinfo):
+    """Rank a page from its matchinfo(pages_fts, 'pcx').
+
+    Every word counts the share of all its hits found in the page, so
+    rare words weigh more than common ones.
+    """
+    values = array.array('I', str(matchinfo))
+    score = 0.0
+    for i in range(values[0] * values[1]):
+        hits, all_hits = values[2 + i * 3], values[3 + i * 3]
+        if hits:
+            score += float(hits) / all_hits
+    return score
+
+
+def _connect(db_path, timeout):
+    connection = sqlite3.connect(db_path, timeout=timeout)
+    # Needed by every connection reading or writing pages_fts.
+    connection.create_function('page_compress', 1, _compress)
+    connection.create_function('page_uncompress', 1, _uncompress)
+    connection.create_function('page_rank', 1, _rank)
+    return connection
+
+
+class _Indexer(threading.Thread):
+    """Thread owning the connection that writes pages.db."""
+
+    def __init__(self, db_path, timeout):
+        threading.Thread.__init__(self, name='page-indexer')
+        self.daemon = True
+
+        self._db_path = db_path
+        self._timeout = timeout
+        self._queue = Queue.Queue()
+
+    def write(self, function, *args):
+        self._queue.put((function, args))
+
+    def wait(self):
+        """Block until all the writes handed so far are done."""
+        self._queue.join()
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        connection = _connect(self._db_path, self._timeout)
+
+        while True:
+            write = self._queue.get()
+            try:
+                if write is None:
+                    break
+                function, args = write
+                with connection:
+                    function(connection.cursor(), *args)
+            except sqlite3.Error:
+                logging.exception('Could not update the page index')
+            finally:
+                self._queue.task_done()
+
+        connection.close()
+
+
+class PageIndex(object):
+    """Index of the text of the pages, searched with search().
+
+    Pages keep at most MAX_PAGE_CHARS characters of text, and are
+    indexed again after REINDEX_DAYS.  When the text of all the pages
+    is over MAX_BYTES the pages indexed first are dropped.  The pages
+    expired from the history are dropped with remove_pages().
+    """
+
+    MAX_PAGE_CHARS = 16 * 1024
+    MAX_BYTES = 20 * 1024 * 1024
+    REINDEX_DAYS = 1
+    MAX_SEARCH_MATCHES = 10
+    PREFIX_CHARS = 3
+    LOCK_TIMEOUT = 5
+
+    def __init__(self):
+        self._db_path = os.path.join(activity.get_activity_root(),
+                                     'data', 'pages.db')
+        # The uris handed to the indexer since the activity started.
+        self._queued = set()
+
+        self._connection = _connect(self._db_path, self.LOCK_TIMEOUT)
+        cursor = self._connection.cursor()
+        try:
+            # Searches don't wait for the indexer.
+            cursor.execute('pragma journal_mode=wal')
+            cursor.execute('create table if not exists pages '
+                           '(uri text unique, size integer, '
+                           'indexed integer)')
+            cursor.execute('create index if not exists pages_indexed '
+                           'on pages (indexed)')
+            cursor.execute("""create virtual table if not exists pages_fts
+                              using fts4 (text,
+                                          compress=page_compress,
+                                          uncompress=page_uncompress)
+                           """)
+            self._connection.commit()
+        finally:
+            cursor.close()
+
+        self._indexer = _Indexer(self._db_path, self.LOCK_TIMEOUT)
+        self._indexer.start()
+
+    def add_page(self, uri, text):
+        """Index text as the content of the page at uri."""
+        if uri in self._queued or not text:
+            return
+        if not uri.startswith('http://') and \
+                not uri.startswith('https://'):
+            return
+
+        if not isinstance(text, unicode):
+            text = unicode(text, 'utf-8', 'replace')
+        text = u' '.join(text[:self.MAX_PAGE_CHARS].split())
+
+        self._queued.add(uri)
+        self._indexer.write(self._write_page, uri, text)
+
+    def remove_pages(self, uris):
+        self._queued.difference_update(uris)
+        self._indexer.write(self._write_remove, uris)
+
+    def search(self, text):
+        """Return the uris and excerpts of the pages containing the words
+        of text, best first.
+
+        The last word can also be the start of a longer word, once it
+        has PREFIX_CHARS characters.
+        """
+        tokens = _TOKEN_RE.findall(text.lower())
+        if not tokens:
+            return []
+        query = ' '.join(tokens)
+        if len(tokens[-1]) >= self.PREFIX_CHARS:
+            query += '*'
+
+        cursor = self._connection.cursor()
+        try:
+            # Only the best pages are uncompressed for their excerpt.
+            cursor.execute('select pages.uri, '
+                           'snippet(pages_fts, "", "", "...", -1, 12) '
+                           'from pages_fts join (select docid, '
+                           'page_rank(matchinfo(pages_fts, "pcx")) as rank '
+                           'from pages_fts where pages_fts match ? '
+                           'order by rank desc limit ?) as best '
+                           'on pages_fts.docid=best.docid '
+                           'join pages on pages.rowid=best.docid '
+                           'where pages_fts match ? '
+                           'order by best.rank desc',
+                           (query, self.MAX_SEARCH_MATCHES, query))
+            return cursor.fetchall()
+        except sqlite3.Error:
+            logging.exception('Could not search the page index')
+            return []
+        finally:
+            cursor.close()
+
+    def flush(self):
+        """Block until the pages handed so far are indexed."""
+        self._indexer.wait()
+
+    def close(self):
+        self._indexer.stop()
+        self._connection.close()
+
+    def _write_page(self, cursor, uri, text):
+        now = int(time.time())
+        cursor.execute('select rowid, indexed from pages where uri=?',
+                       (uri,))
+        row = cursor.fetchone()
+        if row is not None:
+            rowid, indexed = row
+            if now - indexed < self.REINDEX_DAYS * 24 * 60 * 60:
+                return
+            cursor.execute('delete from pages_fts where docid=?', (rowid,))
+            cursor.execute('delete from pages where rowid=?', (rowid,))
+
+        cursor.execute('insert into pages (uri, size, indexed) '
+                       'values (?, ?, ?)',
+                       (uri, len(text.encode('utf-8')), now))
+        cursor.execute('insert into pages_fts (docid, text) values (?, ?)',
+                       (cursor.lastrowid, text))
+        self._trim(cursor)
+
+    def _trim(self, cursor):
+        cursor.execute('select sum(size) from pages')
+        excess = (cursor.fetchone()[0] or 0) - self.MAX_BYTES
+        if excess <= 0:
+            return
+
+        # Make room for a few more pages at once.
+        excess += self.MAX_BYTES / 10
+        rowids = []
+        cursor.execute('select rowid, size from pages order by indexed')
+        for rowid, size in cursor.fetchall():
+            if excess <= 0:
+                break
+            rowids.append((rowid,))
+            excess -= size
+
+        cursor.executemany('delete from pages_fts where docid=?', rowids)
+        cursor.executemany('delete from pages where rowid=?', rowids)
+        logging.debug('Dropped %d pages from the page index', len(rowids))
+
+    def _write_remove(self, cursor, uris):
+        for uri in uris:
+            cursor.execute('select rowid from pages where uri=?', (uri,))
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute('delete from pages_fts where docid=?', row)
+                cursor.execute('delete from pages where rowid=?', row)
+
+
+def get_page_index():
+    """Return the PageIndex, or None unless BROWSE_PAGE_INDEX is set."""
+    global _page_index
+    if _page_index is None and _USE_PAGE_INDEX:
+        _page_index = PageIndex()
+        atexit.register(_page_index.close)
+    return _page_index
@@ -15,138 +15,2565 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import re
+import json
+import atexit
+import signal
+import logging
 import sqlite3
+import threading
+import time
+import Queue
+import urlparse
 from datetime import datetime, timedelta
 
+from gi.repository import GObject
+
 from sugar3.activity import activity
 
 _store = None
 
+# SQLite learnt 'insert ... on conflict do update' in 3.24.0.
+_HAVE_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# And 'pragma quick_check(table)' in 3.33.0.
+_HAVE_CHECK_TABLE = sqlite3.sqlite_version_info >= (3, 33, 0)
+
+# Characters that the FTS 'simple' tokenizer keeps inside a token.
+_TOKEN_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+# The user, host and port of an absolute or scheme relative uri.
+_NETLOC_RE = re.compile(r'(?:[a-zA-Z][a-zA-Z0-9+.-]*:)?//([^/?#]*)')
+
+# Kinds of visit, used to weight the frecency of places.
+VISIT_LINK = 0
+VISIT_TYPED = 1
+VISIT_RELOAD = 2
+
+_VISIT_WEIGHTS = {
+    VISIT_LINK: 1.0,
+    VISIT_TYPED: 2.0,
+    VISIT_RELOAD: 0.2,
+}
+
+# Frecency is the sum, over all the visits, of the visit weight
+# decayed by half every FRECENCY_HALF_LIFE seconds.  Rather than
+# decaying every row as time passes, each visit adds its weight grown
+# by the time elapsed since _FRECENCY_EPOCH, which keeps the order of
+# the rows the same.  With a 30 days half life doubles don't overflow
+# until the 2090s.
+FRECENCY_HALF_LIFE = 30 * 24 * 60 * 60
+_FRECENCY_EPOCH = time.mktime((2013, 1, 1, 0, 0, 0, 0, 0, -1))
+
+# What import_places() does with places already in the history: keep
+# them as they are, overwrite them, or add the imported visits.
+MERGE_SKIP = 'skip'
+MERGE_REPLACE = 'replace'
+MERGE_SUM = 'sum'
+
+_MERGE_UPDATES = {
+    MERGE_REPLACE: 'update places set title=?, bookmark=?, '
+                   'gecko_flags=?, visits=?, last_visit=?, frecency=? '
+                   'where uri=?',
+    MERGE_SUM: 'update places set '
+               'title=coalesce(nullif(title, ""), ?), '
+               'bookmark=max(bookmark, ?), gecko_flags=?, '
+               'visits=visits + ?, last_visit=max(last_visit, ?), '
+               'frecency=coalesce(frecency, 0) + ? where uri=?',
+}
+
+# Log the last visit of a place written with its visits rollup, as
+# added, imported or updated places only bring their last visit.
+_LOG_LAST_VISIT = ('insert into visits (place_id, visit_date, transition) '
+                   'select rowid, last_visit, ? from places where uri=? '
+                   'and visits > 0 and not exists (select * from visits '
+                   'where place_id=places.rowid and '
+                   'visit_date=places.last_visit)')
+
+# Set BROWSE_PLACES_WAL=1 to run places.db in WAL mode, with a
+# background thread doing all the writes.
+_USE_WAL = os.environ.get('BROWSE_PLACES_WAL') == '1'
+
+# Set BROWSE_PLACES_FUZZY=1 to keep a trigram index of the places, used
+# to find misspelt words when the search finds too few places.
+_USE_FUZZY = os.environ.get('BROWSE_PLACES_FUZZY') == '1'
+
+# Set BROWSE_PLACES_TRACE=1 to time the SQL statements, see _Tracer.
+# Statements slower than BROWSE_PLACES_SLOW_MS are logged with their
+# query plan.
+_USE_TRACE = os.environ.get('BROWSE_PLACES_TRACE') == '1'
+
+# Bounds of the history, lower them on machines short of storage.
+_MAX_PLACES = int(os.environ.get('BROWSE_PLACES_MAX_PLACES', '50000'))
+_MAX_MEGABYTES = int(os.environ.get('BROWSE_PLACES_MAX_MB', '50'))
+_SLOW_MS = int(os.environ.get('BROWSE_PLACES_SLOW_MS', '100'))
+
+
+def _parse_timestamp(value):
+    """Return a last_visit value as a datetime.
+
+    last_visit is stored in seconds since the epoch, older versions
+    stored it as text through the sqlite3 datetime adapter.
+    """
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, (int, long, float)):
+        return datetime.fromtimestamp(value)
+    # Much faster than strptime(), this runs for every imported place.
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]),
+                    int(value[17:19]), int((value[20:26] + '000000')[:6]))
+
+
+def get_host(uri):
+    """Return the host of uri in lower case without 'www.' and port."""
+    if not uri:
+        # Older versions stored places without uri, see ticket #3400.
+        return ''
+    # The hostname of urlparse.urlsplit(), which is a few times slower
+    # and imports and search results split every uri.
+    match = _NETLOC_RE.match(uri)
+    if match is None:
+        return ''
+    host = match.group(1).rpartition('@')[2]
+    if host.startswith('['):
+        host = host[1:].partition(']')[0]
+    else:
+        host = host.partition(':')[0]
+    host = host.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    return host
+
+
+def _get_domain(host):
+    # The host without its first label, so that 'wiki' finds
+    # en.wikipedia.org.  None when that would leave a bare TLD.
+    if host.count('.') < 2:
+        return None
+    return host[host.index('.') + 1:]
+
+
+def _split_uri(uri):
+    host = get_host(uri)
+    return host, _get_domain(host)
+
+
+def group_by_host(places, limit):
+    """Return up to limit of places, best first, keeping their order
+    but taking the best place of each host before the others."""
+    best = []
+    others = []
+    hosts = set()
+    for place in places:
+        host = get_host(place.uri)
+        if host in hosts:
+            others.append(place)
+        else:
+            hosts.add(host)
+            best.append(place)
+    return (best + others)[:limit]
+
+
+def _get_trigrams(text):
+    """Return the set of three letter substrings of the words of text."""
+    trigrams = set()
+    for word in _TOKEN_RE.findall(text.lower()):
+        for i in range(len(word) - 2):
+            trigrams.add(word[i:i + 3])
+    return trigrams
+
+
+def _get_place_trigrams(uri, title):
+    parts = urlparse.urlsplit(uri)
+    return _get_trigrams(u'%s %s %s' % (parts.netloc, parts.path, title))
+
+
+def _match_words(words, uri, title):
+    """Whether every word of words starts a token of uri or title, as
+    'places_fts match' does with 'word*'."""
+    tokens = _TOKEN_RE.findall(u'%s %s' % (uri or u'', title or u''))
+    tokens = [token.lower() for token in tokens]
+    for word in words.split():
+        for token in tokens:
+            if token.startswith(word):
+                break
+        else:
+            return False
+    return True
+
+
+def _prefix_range(prefix):
+    # The strings starting with prefix are >= prefix and < the upper
+    # bound, which lets SQLite answer from an index.
+    return prefix, prefix + u'\uffff'
+
+
+def _to_epoch(date):
+    """Return the seconds since the epoch of a date or a last_visit."""
+    if isinstance(date, (int, long, float)):
+        return int(date)
+    if isinstance(date, basestring):
+        date = _parse_timestamp(date)
+    return int(time.mktime(date.timetuple()))
+
+
+def frecency_boost(date, visit_type=VISIT_LINK):
+    """Return what a visit at date adds to the frecency of a place."""
+    elapsed = _to_epoch(date) - _FRECENCY_EPOCH
+    return _VISIT_WEIGHTS[visit_type] * 2 ** (elapsed / FRECENCY_HALF_LIFE)
+
+
+def _read_places(fileobj):
+    """Yield the rows to insert for the JSON lines of fileobj."""
+    for line in fileobj:
+        if not line.strip():
+            continue
+
+        data = json.loads(line)
+        visits = data.get('visits', 0)
+        last_visit = data.get('last_visit')
+        if last_visit is None:
+            last_visit = int(time.time())
+        else:
+            last_visit = _to_epoch(last_visit)
+        frecency = data.get('frecency')
+        if frecency is None:
+            frecency = (visits + 1) * frecency_boost(last_visit)
+
+        yield (data['uri'], data.get('title', ''),
+               data.get('bookmark', False), data.get('gecko_flags', 0),
+               visits, last_visit, frecency)
+
+
+# Result of a step whose transaction was rolled back, see _Step.
+_FAILED = object()
+
+
+class _Step(list):
+    """Result of a step of background work, filled by its write.
+
+    When the transaction of the step fails, even before the write
+    runs, _write_batch() sets the result to _FAILED.  The step can be
+    queued again, failures counts how many times in a row it failed.
+    """
+
+    def __init__(self):
+        list.__init__(self)
+        self.failures = 0
+
+
+def _write_batch(connection, batch):
+    """Apply a list of (write, args) pairs in a single transaction."""
+    # Take the write lock upfront, so that waiting for another Browse
+    # instance honours the timeout of the connection.
+    connection.isolation_level = None
+    cursor = connection.cursor()
+
+    try:
+        cursor.execute('begin immediate')
+        for write, args in batch:
+            write(cursor, *args)
+        cursor.execute('commit')
+    except Exception:
+        # Whatever failed, don't leave the transaction open.
+        logging.exception('Could not write %d history changes', len(batch))
+        try:
+            cursor.execute('rollback')
+        except sqlite3.OperationalError:
+            # The transaction didn't even start.
+            pass
+        for write, args in batch:
+            for arg in args:
+                if isinstance(arg, _Step):
+                    arg[:] = [_FAILED]
+    finally:
+        cursor.close()
+        connection.isolation_level = ''
+
+
+_POWER_SUPPLY_PATH = '/sys/class/power_supply'
+
+
+def _on_battery():
+    """Return whether the machine is running on a battery."""
+    try:
+        names = os.listdir(_POWER_SUPPLY_PATH)
+    except OSError:
+        return False
+
+    for name in names:
+        try:
+            with open(os.path.join(_POWER_SUPPLY_PATH, name,
+                                   'status')) as status:
+                if status.read().strip() == 'Discharging':
+                    return True
+        except IOError:
+            # Not a battery.
+            continue
+    return False
+
+
+# Schema migrations of places.db.  The database is at version N when
+# the first N migrations have been applied, as recorded in its
+# user_version.  Each migration is an (upgrade, backfill) pair:
+#
+# upgrade(cursor) changes the schema, it runs while the store is
+# opened and should be fast.  It can return False to skip the
+# backfill.
+#
+# backfill(cursor, first, last) updates the places with rowid in
+# (first, last].  It runs in chunks from the main loop after startup,
+# while the store is in use, so the rows it didn't reach yet have to
+# keep working.  It only sees the places that existed when the
+# upgrade ran, later places must be handled by the code writing them.
+#
+# Never change a migration once released, add a new one instead.
+
+
+def _create_places(cursor):
+    # Create table to store the visited places.  Note that
+    # bookmark and gecko_flags fields aren't used anymore in
+    # WebKit port, but are kept for backwards compatibility.
+    cursor.execute("""create table if not exists places (
+                        uri         text,
+                        title       text,
+                        bookmark    boolean,
+                        gecko_flags integer,
+                        visits      integer,
+                        last_visit  timestamp
+                      );
+                   """)
+    # Progress of the backfills still running.
+    cursor.execute("""create table backfills (
+                        version     integer primary key,
+                        position    integer,
+                        last        integer
+                      );
+                   """)
+
+
+# Until its backfill is done, the search index ignores the places it
+# didn't reach yet.
+_FTS_PENDING = '''not exists (select * from backfills where version=2
+                 and %(row)s.rowid > position and %(row)s.rowid <= last)'''
+
+
+def _create_search_index(cursor):
+    """Create the full-text index used by SqliteStore.search().
+
+    The index is an external content FTS4 table over the uri and
+    title of the places table, kept in sync by triggers.
+    """
+    try:
+        cursor.execute("""create virtual table places_fts using fts4 (
+                            content="places", uri, title
+                          );
+                       """)
+    except sqlite3.OperationalError:
+        logging.warning('SQLite has no FTS4 support, history search '
+                        'will scan the places table')
+        return False
+
+    cursor.execute("""create trigger places_fts_before_update
+                        before update of uri, title on places
+                        when %s begin
+                          delete from places_fts where docid=old.rowid;
+                        end;
+                   """ % _FTS_PENDING % {'row': 'old'})
+    cursor.execute("""create trigger places_fts_before_delete
+                        before delete on places
+                        when %s begin
+                          delete from places_fts where docid=old.rowid;
+                        end;
+                   """ % _FTS_PENDING % {'row': 'old'})
+    cursor.execute("""create trigger places_fts_after_update
+                        after update of uri, title on places
+                        when %s begin
+                          insert into places_fts (docid, uri, title)
+                            values (new.rowid, new.uri, new.title);
+                        end;
+                   """ % _FTS_PENDING % {'row': 'new'})
+    cursor.execute("""create trigger places_fts_after_insert
+                        after insert on places
+                        when %s begin
+                          insert into places_fts (docid, uri, title)
+                            values (new.rowid, new.uri, new.title);
+                        end;
+                   """ % _FTS_PENDING % {'row': 'new'})
+
+
+def _backfill_search_index(cursor, first, last):
+    cursor.execute('insert into places_fts (docid, uri, title) '
+                   'select rowid, uri, title from places '
+                   'where rowid > ? and rowid <= ?', (first, last))
+
+
+def _create_uri_index(cursor):
+    """Make uri a unique key of the places table.
+
+    Older databases can hold several rows for the same uri.  Those
+    are merged first into the oldest row, summing their visits and
+    keeping the most recent last_visit.
+    """
+    cursor.execute("""create temp table places_merged (
+                        keep        integer primary key,
+                        title       text,
+                        visits      integer,
+                        last_visit  timestamp
+                      );
+                   """)
+    cursor.execute('insert into places_merged select min(rowid), '
+                   'max(nullif(title, "")), sum(visits), '
+                   'max(last_visit) from places where uri is not null '
+                   'group by uri having count(*) > 1')
+    if cursor.rowcount:
+        logging.debug('Merging %d duplicated places', cursor.rowcount)
+        cursor.execute('update places set '
+                       'title=coalesce((select title from places_merged '
+                       'where keep=places.rowid), title), '
+                       'visits=(select visits from places_merged '
+                       'where keep=places.rowid), '
+                       'last_visit=(select last_visit from places_merged '
+                       'where keep=places.rowid) '
+                       'where rowid in (select keep from places_merged)')
+        cursor.execute('delete from places where uri is not null and '
+                       'rowid not in (select min(rowid) from places '
+                       'where uri is not null group by uri)')
+    cursor.execute('drop table places_merged')
+    cursor.execute('create unique index places_uri on places (uri)')
+
+
+def _add_frecency(cursor):
+    cursor.execute('alter table places add column frecency real')
+    cursor.execute('create index places_frecency on places (frecency)')
+
+
+def _backfill_frecency(cursor, first, last):
+    # Older databases only know the number of visits and the last
+    # one, so all the visits are counted as links at last_visit.
+    cursor.execute('select rowid, visits, last_visit from places '
+                   'where rowid > ? and rowid <= ? and frecency is null '
+                   'and last_visit is not null', (first, last))
+    updates = []
+    for rowid, visits, last_visit in cursor.fetchall():
+        boost = frecency_boost(last_visit)
+        updates.append((((visits or 0) + 1) * boost, rowid))
+    cursor.executemany('update places set frecency=? where rowid=?',
+                       updates)
+
+
+def _create_last_visit_index(cursor):
+    cursor.execute('create index places_last_visit on places '
+                   '(last_visit)')
+
+
+def _create_visits(cursor):
+    """Create the log of the visits to the places.
+
+    place_id is the rowid of the place, visit_date the seconds since
+    the epoch and transition the VISIT_* type of the visit.  visits
+    and last_visit of the places table are kept as a rollup of it.
+    """
+    cursor.execute("""create table visits (
+                        place_id    integer not null,
+                        visit_date  integer not null,
+                        transition  integer not null
+                      );
+                   """)
+    cursor.execute('create index visits_date on visits (visit_date)')
+    cursor.execute('create index visits_place on visits (place_id)')
+    cursor.execute("""create trigger visits_after_place_delete
+                        after delete on places begin
+                          delete from visits where place_id=old.rowid;
+                        end;
+                   """)
+
+
+def _backfill_visits(cursor, first, last):
+    # Only the last visit of the older places is known.
+    cursor.execute('insert into visits (place_id, visit_date, transition) '
+                   'select rowid, case typeof(last_visit) '
+                   'when "text" then '
+                   'cast(strftime("%s", last_visit, "utc") as integer) '
+                   'else last_visit end, '
+                   '? from places where rowid > ? and rowid <= ? and '
+                   'last_visit is not null and not exists (select * from '
+                   'visits where place_id=places.rowid)',
+                   (VISIT_LINK, first, last))
+
+
+def _add_host(cursor):
+    cursor.execute('alter table places add column host text')
+    cursor.execute('alter table places add column domain text')
+    cursor.execute('create index places_host on places (host, frecency)')
+    cursor.execute('create index places_domain on places (domain)')
+
+
+def _backfill_host(cursor, first, last):
+    cursor.execute('select rowid, uri from places '
+                   'where rowid > ? and rowid <= ? and host is null '
+                   'and uri is not null', (first, last))
+    updates = [_split_uri(uri) + (rowid,) for rowid, uri in cursor]
+    cursor.executemany('update places set host=?, domain=? where rowid=?',
+                       updates)
+
+
+def _convert_last_visit(cursor):
+    # Only the values change, last_visit keeps its declared type.
+    pass
+
+
+def _backfill_last_visit(cursor, first, last):
+    # From local time text to seconds since the epoch.  Until it is
+    # done, the text values sort after all the converted ones.
+    cursor.execute('update places set last_visit='
+                   'cast(strftime("%s", last_visit, "utc") as integer) '
+                   'where rowid > ? and rowid <= ? and '
+                   'typeof(last_visit)="text"', (first, last))
+
+
+def _create_bookmark_index(cursor):
+    cursor.execute('create index places_bookmark on places (bookmark)')
+
+
+def _create_maintenance(cursor):
+    # When each SqliteStore.start_maintenance() job last ran, in
+    # seconds since the epoch, and the seconds it took.
+    cursor.execute('create table maintenance (job text primary key, '
+                   'last_run integer, duration real)')
+
+
+def _drop_last_visit_index(cursor):
+    # Nothing looks places up by last_visit, and every visit had to
+    # update the index.  The archive keeps its own, expiry trims by it.
+    cursor.execute('drop index if exists places_last_visit')
+
+
+_MIGRATIONS = [
+    (_create_places, None),
+    (_create_search_index, _backfill_search_index),
+    (_create_uri_index, None),
+    (_add_frecency, _backfill_frecency),
+    (_create_last_visit_index, None),
+    (_create_visits, _backfill_visits),
+    (_add_host, _backfill_host),
+    (_convert_last_visit, _backfill_last_visit),
+    (_create_bookmark_index, None),
+    (_create_maintenance, None),
+    (_drop_last_visit_index, None),
+]
+
+# The migration adding the search index.
+_FTS_VERSION = 2
+
+# The migration adding the frecency expiry evicts by.
+_FRECENCY_VERSION = 4
+
+_MAX_ROWID = 2 ** 63 - 1
+
 
 class Place(object):
-    def __init__(self, uri=''):
+    __slots__ = ('uri', 'title', 'bookmark', 'gecko_flags', 'visits',
+                 '_last_visit', 'frecency')
+
+    def __init__(self, uri='', title='', bookmark=False, gecko_flags=0,
+                 visits=0, last_visit=None, frecency=0):
         self.uri = uri
-        self.title = ''
-        self.bookmark = False
-        self.gecko_flags = 0
-        self.visits = 0
-        self.last_visit = datetime.now()
+        self.title = title
+        self.bookmark = bookmark
+        self.gecko_flags = gecko_flags
+        self.visits = visits
+        if last_visit is None:
+            last_visit = int(time.time())
+        # Kept as read from the database, usually seconds since the
+        # epoch, and only made a datetime when asked.
+        self._last_visit = last_visit
+        self.frecency = frecency
+
+    def _get_last_visit(self):
+        return _parse_timestamp(self._last_visit)
+
+    def _set_last_visit(self, last_visit):
+        self._last_visit = last_visit
+
+    last_visit = property(_get_last_visit, _set_last_visit)
+
+
+# Columns read into a Place by _place_factory.  Return uri and title
+# as empty strings instead of None.  Previous versions of Browse were
+# allowing to store None for those fields in the places database.
+# See ticket #3400 .
+_PLACE_COLUMNS = 'coalesce(uri, ""), coalesce(title, ""), bookmark, ' \
+    'gecko_flags, visits, last_visit, frecency'
+
+
+def _place_factory(cursor, row):
+    return Place(*row)
+
+
+def _rowid_place_factory(cursor, row):
+    return row[0], Place(*row[1:])
+
 
+class _Tracer(object):
+    """Statistics of the SQL statements run by a SqliteStore.
+
+    For every statement it counts the calls, the rows read or changed
+    and the time spent, as a histogram.  The time spent waiting for
+    the write lock shows as the 'begin immediate' statement.
+    """
+
+    # Upper bounds of the histogram buckets, in milliseconds.
+    BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+
+    def __init__(self, slow_ms):
+        self._slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self._statements = {}
+
+    def record(self, connection, sql, args, duration, rows):
+        milliseconds = duration * 1000
+        key = ' '.join(sql.split())
+
+        with self._lock:
+            stats = self._statements.get(key)
+            if stats is None:
+                stats = self._statements[key] = \
+                    [0, 0, 0.0, 0.0, [0] * (len(self.BUCKETS) + 1)]
+            stats[0] += 1
+            stats[1] += rows
+            stats[2] += milliseconds
+            stats[3] = max(stats[3], milliseconds)
+            bucket = 0
+            while bucket < len(self.BUCKETS) and \
+                    milliseconds >= self.BUCKETS[bucket]:
+                bucket += 1
+            stats[4][bucket] += 1
+
+        if milliseconds >= self._slow_ms:
+            logging.warning('Slow places.db statement, %.1f ms, %d rows: '
+                            '%s%s', milliseconds, rows, key,
+                            self._explain(connection, sql, args))
+
+    def _explain(self, connection, sql, args):
+        if args is None or sql.split(None, 1)[0].lower() not in \
+                ['select', 'insert', 'update', 'delete']:
+            return ''
+        try:
+            cursor = sqlite3.Connection.cursor(connection)
+            cursor.execute('explain query plan ' + sql, args)
+            plan = cursor.fetchall()
+            cursor.close()
+        except sqlite3.Error:
+            return ''
+        return ''.join(['\n  ' + str(row[-1]) for row in plan])
+
+    def get_summary(self):
+        """Return the statistics as text, slowest statements first."""
+        with self._lock:
+            statements = sorted(self._statements.items(),
+                                key=lambda item: item[1][2], reverse=True)
+            lines = ['places.db statements, histogram bounds %s ms' %
+                     self.BUCKETS]
+            for key, (calls, rows, total, slowest, buckets) in statements:
+                lines.append('%6d calls %8d rows %10.1f ms %8.1f ms max '
+                             '%s' % (calls, rows, total, slowest, buckets))
+                lines.append('    ' + key[:200])
+        return '\n'.join(lines)
+
+
+class _TracingCursor(sqlite3.Cursor):
+    """Cursor timing its statements for the _Tracer of its connection.
+
+    A statement is recorded when the next one starts or the cursor is
+    closed, so that fetching its rows is part of its time.
+    """
+
+    def __init__(self, connection):
+        sqlite3.Cursor.__init__(self, connection)
+        self._statement = None
+
+    def _start(self, sql, args):
+        self._finish()
+        self._statement = [sql, args, 0.0, 0]
+
+    def _finish(self):
+        statement = self._statement
+        if statement is not None:
+            self._statement = None
+            rows = statement[3]
+            if statement[1] is None or rows == 0:
+                rows = max(rows, self.rowcount)
+            self.connection.tracer.record(self.connection, statement[0],
+                                          statement[1], statement[2], rows)
+
+    def _time(self, function, *args):
+        start = time.time()
+        try:
+            return function(self, *args)
+        finally:
+            if self._statement is not None:
+                self._statement[2] += time.time() - start
+
+    def execute(self, sql, args=()):
+        self._start(sql, args)
+        return self._time(sqlite3.Cursor.execute, sql, args)
+
+    def executemany(self, sql, seq):
+        self._start(sql, None)
+        return self._time(sqlite3.Cursor.executemany, sql, seq)
+
+    def fetchone(self):
+        row = self._time(sqlite3.Cursor.fetchone)
+        if row is not None and self._statement is not None:
+            self._statement[3] += 1
+        return row
+
+    def fetchall(self):
+        rows = self._time(sqlite3.Cursor.fetchall)
+        if self._statement is not None:
+            self._statement[3] += len(rows)
+        return rows
+
+    def next(self):
+        row = self._time(sqlite3.Cursor.next)
+        if self._statement is not None:
+            self._statement[3] += 1
+        return row
+
+    def close(self):
+        self._finish()
+        sqlite3.Cursor.close(self)
+
+    def __del__(self):
+        try:
+            self._finish()
+        except sqlite3.Error:
+            pass
+
+
+class _TracingConnection(sqlite3.Connection):
+
+    tracer = None
+
+    def cursor(self, factory=_TracingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+def _attach_archive(connection, db_path):
+    """Attach the archive of evicted places next to db_path as 'archive'.
+
+    The archive only has the columns worth searching, and no search
+    index.  Expiry appends to it, and only search_archive() reads it.
+    """
+    path = os.path.join(os.path.dirname(db_path), 'places-archive.db')
+    connection.execute('attach database ? as archive', (path,))
+    connection.execute("""create table if not exists archive.places (
+                            uri         text,
+                            title       text,
+                            visits      integer,
+                            last_visit  integer,
+                            frecency    real
+                          );
+                       """)
+    connection.execute('create unique index if not exists '
+                       'archive.places_uri on places (uri)')
+    connection.execute('create index if not exists '
+                       'archive.places_last_visit on places (last_visit)')
+    connection.commit()
+
+
+def _connect(db_path, timeout, tracer):
+    if tracer is None:
+        connection = sqlite3.connect(db_path, timeout=timeout)
+    else:
+        connection = sqlite3.connect(db_path, timeout=timeout,
+                                     factory=_TracingConnection)
+        connection.tracer = tracer
+    connection.create_function('match_words', 3, _match_words)
+    return connection
+
+
+class _Writer(threading.Thread):
+    """Thread owning the connection that does all the history writes."""
+
+    def __init__(self, db_path, synchronous, timeout, tracer):
+        threading.Thread.__init__(self, name='places-writer')
+        self.daemon = True
+
+        self._db_path = db_path
+        self._synchronous = synchronous
+        self._timeout = timeout
+        self._tracer = tracer
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._depth = 0
+
+    def write(self, batch):
+        with self._lock:
+            self._depth += len(batch)
+        self._queue.put(batch)
+
+    def call(self, function, *args):
+        """Call function(connection, *args) between two batches, out
+        of any transaction."""
+        self._queue.put((function, args))
+
+    def get_queue_depth(self):
+        with self._lock:
+            return self._depth
+
+    def wait(self):
+        """Block until all the batches handed so far are committed."""
+        self._queue.join()
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        connection = _connect(self._db_path, self._timeout, self._tracer)
+        connection.execute('pragma synchronous=%s' % self._synchronous)
+        _attach_archive(connection, self._db_path)
+
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    break
+                if isinstance(batch, tuple):
+                    function, args = batch
+                    function(connection, *args)
+                else:
+                    _write_batch(connection, batch)
+            except Exception:
+                # Keep writing the next batches, wait() relies on it.
+                logging.exception('History writer failed')
+            finally:
+                if isinstance(batch, list):
+                    with self._lock:
+                        self._depth -= len(batch)
+                self._queue.task_done()
+
+        connection.close()
+
+
+class _Searcher(threading.Thread):
+    """Thread running the searches of SqliteStore.search_async().
+
+    Only the last search requested is kept, a new request replaces the
+    one waiting and interrupts the one running.
+    """
+
+    def __init__(self, db_path, timeout, tracer, search):
+        threading.Thread.__init__(self, name='places-searcher')
+        self.daemon = True
+
+        self._db_path = db_path
+        self._timeout = timeout
+        self._tracer = tracer
+        self._search = search
+        self._connection = None
+        self._condition = threading.Condition()
+        self._request = None
+        self._generation = 0
+        self._running = None
+        self._stopped = False
+
+    def search(self, text, fts, callback):
+        with self._condition:
+            self._generation += 1
+            self._request = (self._generation, text, fts, callback)
+            self._interrupt()
+            self._condition.notify()
+
+    def cancel(self):
+        with self._condition:
+            self._generation += 1
+            self._request = None
+            self._interrupt()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._request = None
+            self._interrupt()
+            self._condition.notify()
+        self.join()
+
+    def _interrupt(self):
+        if self._running is not None:
+            self._connection.interrupt()
+
+    def run(self):
+        self._connection = _connect(self._db_path, self._timeout,
+                                    self._tracer)
+
+        while True:
+            with self._condition:
+                while self._request is None and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    break
+                generation, text, fts, callback = self._request
+                self._request = None
+                self._running = generation
+
+            try:
+                result = self._search(self._connection, text, fts)
+            except Exception:
+                with self._condition:
+                    interrupted = generation != self._generation
+                if interrupted:
+                    result = None
+                else:
+                    # Keep searching, and answer this search with no
+                    # places rather than leave the caller waiting.
+                    logging.exception('History search failed')
+                    result = []
+            finally:
+                with self._condition:
+                    self._running = None
+
+            if result is not None:
+                GObject.idle_add(self.__deliver_idle_cb, generation,
+                                 callback, result)
+
+        self._connection.close()
+
+    def __deliver_idle_cb(self, generation, callback, result):
+        if generation == self._generation:
+            callback(result)
+        return False
+
+
+class _Expiry(object):
+    """State of an expiry run by SqliteStore.start_expiry()."""
+
+    def __init__(self, cutoff):
+        self.cutoff = cutoff
+        self.start = time.time()
+        self.deleted = 0
+        self.pruned = 0
+        self.duration = 0.0
+        # Places still to evict, counted by the first chunk.
+        self.excess = None
+        # Filled with (uris, pruned, excess, duration) by the chunk
+        # being written.
+        self.step = None
+
+
+class _Maintenance(object):
+    """State of a run of SqliteStore.start_maintenance()."""
+
+    def __init__(self, jobs, convert, size):
+        self.jobs = jobs
+        # Whether places.db has to be vacuumed for auto_vacuum to work.
+        self.convert = convert
+        self.size = size
+        self.start = time.time()
+        # Seconds spent on the current job.
+        self.duration = 0.0
+        # Filled with (finished, duration) by the step being written.
+        self.step = None
+
+
+class SqliteStore(GObject.GObject):
+    """The history of Browse, kept in places.db.
+
+    Changes are announced by signals, emitted once per main loop
+    iteration with the list of all the changes of that iteration:
+
+    visit-added: (uri, visit_type) pairs
+    title-changed: (uri, title) pairs
+    bookmark-changed: (uri, bookmarked) pairs
+    places-expired: uris evicted from the history
+    """
+
+    __gsignals__ = {
+        'visit-added': (GObject.SignalFlags.RUN_FIRST,
+                        None,
+                        ([object])),
+        'title-changed': (GObject.SignalFlags.RUN_FIRST,
+                          None,
+                          ([object])),
+        'bookmark-changed': (GObject.SignalFlags.RUN_FIRST,
+                             None,
+                             ([object])),
+        'places-expired': (GObject.SignalFlags.RUN_FIRST,
+                           None,
+                           ([object])),
+    }
+
+    # The order the signals are emitted in, within an iteration.
+    SIGNALS = ['visit-added', 'title-changed', 'bookmark-changed',
+               'places-expired']
 
-class SqliteStore(object):
     MAX_SEARCH_MATCHES = 7
+
+    # Searches rank SEARCH_CANDIDATES places, so the best place of
+    # more hosts can be shown, see group_by_host().  A word of at least
+    # HOST_PREFIX_CHARS characters also finds the hosts it starts.
+    SEARCH_CANDIDATES = MAX_SEARCH_MATCHES * 3
+    HOST_PREFIX_CHARS = 3
+
+    # A full-text search first walks the SEARCH_WALK places with the
+    # highest frecency, enough for the words found in most places.
+    # The search index is only used for the rarer words.
+    SEARCH_WALK = 1000
+
+    # The history is kept under MAX_PLACES places and MAX_BYTES bytes
+    # of database pages, evicting the places with the lowest frecency.
+    # The log of visits only keeps EXPIRE_DAYS.
+    MAX_PLACES = _MAX_PLACES
+    MAX_BYTES = _MAX_MEGABYTES * 1024 * 1024
     EXPIRE_DAYS = 30
 
-    def __init__(self):
-        db_path = os.path.join(activity.get_activity_root(),
-                               'data', 'places.db')
+    # Evicted places are moved to the archive, which keeps the
+    # ARCHIVE_MAX_PLACES most recently visited ones.
+    ARCHIVE_MAX_PLACES = _MAX_PLACES * 4
+
+    # Searches rank bookmarks as if their frecency was BOOKMARK_BOOST
+    # times higher.  Bookmarks are never expired.
+    BOOKMARK_BOOST = 4
+
+    # Writes are queued and committed together, after WRITE_INTERVAL
+    # seconds or as soon as WRITE_BATCH_SIZE of them are waiting.
+    WRITE_INTERVAL = 5
+    WRITE_BATCH_SIZE = 50
+
+    # In WAL mode a commit only waits for the log to be written, not
+    # for the database to be synced, see
+    # http://www.sqlite.org/pragma.html#pragma_synchronous
+    WAL_SYNCHRONOUS = 'normal'
+
+    # Seconds to wait for other Browse instances to release a lock.
+    LOCK_TIMEOUT = 5
+
+    # Expired places are deleted EXPIRE_CHUNK at a time, one chunk
+    # every EXPIRE_INTERVAL milliseconds.
+    EXPIRE_CHUNK = 200
+    EXPIRE_INTERVAL = 50
+
+    # Export reads EXPORT_CHUNK places at a time.  Import inserts
+    # IMPORT_CHUNK places per statement, and commits every
+    # IMPORT_TRANSACTION places.
+    EXPORT_CHUNK = 1000
+    IMPORT_CHUNK = 1000
+    IMPORT_TRANSACTION = 100000
+
+    # Migrations backfill the rowids of BACKFILL_CHUNK places at a
+    # time, one chunk every BACKFILL_INTERVAL milliseconds.
+    BACKFILL_CHUNK = 500
+    BACKFILL_INTERVAL = 50
+
+    # The trigram index is caught up TRIGRAM_CHUNK places at a time.
+    # A fuzzy search gives up after FUZZY_BUDGET seconds, and only
+    # keeps the places sharing FUZZY_SIMILARITY of the trigrams of the
+    # text.  The best FUZZY_CANDIDATES are then ranked by frecency.
+    TRIGRAM_CHUNK = 500
+    FUZZY_BUDGET = 0.1
+    FUZZY_SIMILARITY = 0.5
+    FUZZY_CANDIDATES = 100
+
+    # A step of background work whose transaction fails, usually
+    # because another Browse instance holds the lock for longer than
+    # LOCK_TIMEOUT, is tried again up to STEP_RETRIES times.
+    STEP_RETRIES = 3
+
+    # The maintenance jobs, in the order they run, and how many days
+    # apart.  A step runs every MAINTENANCE_INTERVAL milliseconds, when
+    # the store is idle, the load average is under MAINTENANCE_MAX_LOAD
+    # and the machine is not on battery.  A vacuum step frees up to
+    # VACUUM_PAGES pages, an optimize step merges FTS_MERGE_PAGES pages
+    # of every full-text index, and ANALYZE samples ANALYZE_LIMIT rows
+    # per index.
+    MAINTENANCE_JOBS = [('vacuum', 1), ('optimize', 7), ('analyze', 7),
+                        ('check', 30)]
+    MAINTENANCE_INTERVAL = 1000
+    MAINTENANCE_MAX_LOAD = 1.0
+    VACUUM_PAGES = 100
+    FTS_MERGE_PAGES = 100
+    ANALYZE_LIMIT = 1000
+
+    def __init__(self, wal=False, fuzzy=False, trace=False):
+        GObject.GObject.__init__(self)
+        self._db_path = os.path.join(activity.get_activity_root(),
+                                     'data', 'places.db')
+
+        self._pending = []
+        self._flush_sid = None
+        self._writer = None
+        self._expiry = None
+        self._expiry_stats = None
+        self._maintenance = None
+        self._maintenance_sid = None
+        self._unchecked = None
+        self._convert_at_close = False
+        self._backfills = []
+        self._backfill_step = None
+        self._backfill_sid = None
+        self._trigram_step = None
+        self._trigram_sid = None
+        self._searchers = {}
+        self._tracer = None
+        self._bookmarks = set()
+        self._changes = {}
+        self._changes_sid = None
 
-        self._connection = sqlite3.connect(db_path)
+        if trace:
+            self._tracer = _Tracer(_SLOW_MS)
+            if hasattr(signal, 'SIGUSR1'):
+                signal.signal(signal.SIGUSR1, self.__dump_trace_cb)
+
+        self._connection = _connect(self._db_path, self.LOCK_TIMEOUT,
+                                    self._tracer)
+        cursor = self._connection.cursor()
+
+        # Let expiry give the freed pages back to the file system.  New
+        # files get it right away, older ones once vacuumed, see
+        # start_maintenance().
+        cursor.execute('pragma auto_vacuum=incremental')
+
+        if wal:
+            cursor.execute('pragma journal_mode=wal')
+            if cursor.fetchone()[0] == 'wal':
+                self._writer = _Writer(self._db_path, self.WAL_SYNCHRONOUS,
+                                       self.LOCK_TIMEOUT, self._tracer)
+            else:
+                logging.warning('Could not switch places.db to WAL mode')
+
+        self._migrate()
+        _attach_archive(self._connection, self._db_path)
+
+        cursor.execute('select version from backfills order by version')
+        self._backfills = [row[0] for row in cursor]
+        cursor.close()
+
+        self._update_schema_state()
+        self._fuzzy = self._setup_trigrams(fuzzy)
+        self._load_bookmarks()
+
+        # The schema is ready, from now on only the writer thread
+        # changes the database.
+        if self._writer is not None:
+            self._writer.start()
+
+        self._start_backfills()
+        self._start_trigrams()
+
+    def get_trace_summary(self):
+        """Return the SQL statistics as text, None unless tracing."""
+        if self._tracer is None:
+            return None
+        return self._tracer.get_summary()
+
+    def __dump_trace_cb(self, signum, frame):
+        # Log from the main loop, not from inside the signal handler.
+        GObject.idle_add(self.__dump_trace_idle_cb)
+
+    def __dump_trace_idle_cb(self):
+        logging.info(self.get_trace_summary())
+        return False
+
+    def _migrate(self):
+        """Bring the schema of places.db up to date.
+
+        The schema changes of each missing migration are applied now,
+        in a transaction that also stores the new user_version.  Their
+        backfills are recorded in the backfills table, and run later
+        in chunks from the main loop.
+        """
+        # Let us control the transactions, the sqlite3 module commits
+        # before any statement changing the schema otherwise.
+        self._connection.isolation_level = None
         cursor = self._connection.cursor()
 
-        cursor.execute('select * from sqlite_master where name == "places"')
-        if cursor.fetchone() is None:
-            # Create table to store the visited places.  Note that
-            # bookmark and gecko_flags fields aren't used anymore in
-            # WebKit port, but are kept for backwards compatibility.
-            cursor.execute("""create table places (
-                                uri         text,
-                                title       text,
-                                bookmark    boolean,
-                                gecko_flags integer,
-                                visits      integer,
-                                last_visit  timestamp
+        try:
+            cursor.execute('pragma user_version')
+            version = cursor.fetchone()[0]
+
+            for new_version in range(version + 1, len(_MIGRATIONS) + 1):
+                upgrade, backfill = _MIGRATIONS[new_version - 1]
+                logging.debug('Upgrading places.db to version %d',
+                              new_version)
+
+                cursor.execute('begin immediate')
+                try:
+                    if upgrade(cursor) is not False and \
+                            backfill is not None:
+                        cursor.execute('insert into backfills (version, '
+                                       'position, last) select ?, 0, '
+                                       'max(rowid) from places '
+                                       'having count(*) > 0',
+                                       (new_version,))
+                    cursor.execute('pragma user_version=%d' % new_version)
+                    cursor.execute('commit')
+                except:
+                    cursor.execute('rollback')
+                    raise
+        finally:
+            cursor.close()
+            self._connection.isolation_level = ''
+
+    def _setup_trigrams(self, enable):
+        """Create or drop the trigram index used by fuzzy searches.
+
+        The index is optional, so it lives outside of the migrations.
+        Triggers queue the places added or changed, and the queue is
+        indexed with the next write.  Return whether the index is
+        available.
+        """
+        cursor = self._connection.cursor()
+
+        try:
+            cursor.execute('select * from sqlite_master where name == '
+                           '"places_trigrams"')
+            exists = cursor.fetchone() is not None
+
+            if not enable:
+                if exists:
+                    logging.debug('Dropping the trigram index')
+                    for trigger in ['insert', 'update', 'delete']:
+                        cursor.execute('drop trigger if exists '
+                                       'places_trigrams_after_%s' % trigger)
+                    cursor.execute('drop table places_trigrams')
+                    cursor.execute('drop table trigram_queue')
+                return False
+
+            if exists:
+                return True
+
+            try:
+                cursor.execute("""create virtual table places_trigrams
+                                    using fts4 (grams);
+                               """)
+            except sqlite3.OperationalError:
+                logging.warning('SQLite has no FTS4 support, fuzzy '
+                                'search is disabled')
+                return False
+
+            cursor.execute("""create table trigram_queue (
+                                place_id    integer primary key
                               );
                            """)
-        else:
-            self._cleanup()
+            cursor.execute("""create trigger places_trigrams_after_insert
+                                after insert on places begin
+                                  insert or ignore into trigram_queue
+                                    values (new.rowid);
+                                end;
+                           """)
+            cursor.execute("""create trigger places_trigrams_after_update
+                                after update of uri, title on places begin
+                                  insert or ignore into trigram_queue
+                                    values (new.rowid);
+                                end;
+                           """)
+            cursor.execute("""create trigger places_trigrams_after_delete
+                                after delete on places begin
+                                  delete from places_trigrams
+                                    where docid=old.rowid;
+                                end;
+                           """)
+            cursor.execute('insert into trigram_queue '
+                           'select rowid from places')
+            return True
+        finally:
+            self._connection.commit()
+            cursor.close()
+
+    def _start_trigrams(self):
+        if self._fuzzy and self._trigram_sid is None:
+            self._trigram_sid = GObject.timeout_add(
+                self.BACKFILL_INTERVAL, self.__trigram_timeout_cb)
+
+    def __trigram_timeout_cb(self):
+        step = self._trigram_step
+
+        if step is not None:
+            if not step:
+                # The writer thread didn't get to it yet.
+                return True
+
+            if step[0] is _FAILED:
+                if not self._retry_step(step, 'update the trigram index'):
+                    self._trigram_step = None
+                    self._trigram_sid = None
+                    return False
+            elif step[0] is not False:
+                if step[0] is None:
+                    logging.error('Could not update the trigram index')
+                self._trigram_step = None
+                self._trigram_sid = None
+                return False
+
+        if step is None or step:
+            self._trigram_step = _Step()
+        self._queue_write(self._write_trigrams, self.TRIGRAM_CHUNK,
+                          self._trigram_step)
+        self.flush()
+        return True
+
+    def _write_trigrams(self, cursor, limit, step):
+        finished = None
+        try:
+            cursor.execute('select place_id, uri, title from trigram_queue '
+                           'left join places on places.rowid=place_id '
+                           'limit ?', (limit,))
+            rows = cursor.fetchall()
+
+            ids = [(place_id,) for place_id, uri, title in rows]
+            cursor.executemany('delete from places_trigrams where docid=?',
+                               ids)
+            cursor.executemany('insert into places_trigrams (docid, grams) '
+                               'values (?, ?)',
+                               [(place_id, ' '.join(_get_place_trigrams(
+                                   uri, title or '')))
+                                for place_id, uri, title in rows
+                                if uri is not None])
+            cursor.executemany('delete from trigram_queue '
+                               'where place_id=?', ids)
+
+            finished = len(rows) < limit
+        finally:
+            if step is not None:
+                step.append(finished)
+
+    def _update_schema_state(self):
+        cursor = self._connection.cursor()
+
+        try:
+            cursor.execute('select * from sqlite_master where name == '
+                           '"places_fts"')
+            self._fts_table = cursor.fetchone() is not None
+            self._fts = self._fts_table and \
+                _FTS_VERSION not in self._backfills
+        finally:
+            cursor.close()
+
+    def _start_backfills(self):
+        if self._backfills and self._backfill_sid is None:
+            self._backfill_sid = GObject.timeout_add(
+                self.BACKFILL_INTERVAL, self.__backfill_timeout_cb)
+
+    def __backfill_timeout_cb(self):
+        step = self._backfill_step
+
+        if step is not None:
+            if not step:
+                # The writer thread didn't get to it yet.
+                return True
+
+            if step[0] is _FAILED:
+                if not self._retry_step(step, 'backfill places.db'):
+                    self._backfill_step = None
+                    self._backfill_sid = None
+                    return False
+            elif step[0] is None:
+                logging.error('Could not backfill places.db to version '
+                              '%d, giving up', self._backfills[0])
+                self._backfill_step = None
+                self._backfill_sid = None
+                return False
+            elif step[0]:
+                logging.debug('Backfilled places.db to version %d',
+                              self._backfills.pop(0))
+                self._update_schema_state()
+
+        if not self._backfills:
+            self._backfill_step = None
+            self._backfill_sid = None
+            return False
+
+        if step is None or step:
+            self._backfill_step = _Step()
+        self._queue_write(self._write_backfill, self._backfills[0],
+                          self.BACKFILL_CHUNK, self._backfill_step)
+        self.flush()
+        return True
+
+    def _retry_step(self, step, task):
+        """Empty step for its write to be queued again, unless it failed
+        more than STEP_RETRIES times in a row."""
+        step.failures += 1
+        if step.failures > self.STEP_RETRIES:
+            logging.error('Could not %s, giving up', task)
+            return False
+        logging.warning('Could not %s, retrying', task)
+        del step[:]
+        return True
+
+    def _write_backfill(self, cursor, version, chunk, step):
+        finished = None
+        try:
+            cursor.execute('select position, last from backfills '
+                           'where version=?', (version,))
+            row = cursor.fetchone()
+            if row is None:
+                finished = True
+                return
+
+            # The range is left open while places are imported.
+            position, last = row
+            cursor.execute('select max(rowid) from places')
+            last = min(last, cursor.fetchone()[0] or 0)
+
+            end = min(position + chunk, last)
+            _MIGRATIONS[version - 1][1](cursor, position, end)
+
+            if end >= last:
+                cursor.execute('delete from backfills where version=?',
+                               (version,))
+                finished = True
+            else:
+                cursor.execute('update backfills set position=? '
+                               'where version=?', (end, version))
+                finished = False
+        finally:
+            step.append(finished)
 
     def search(self, text):
+        self.flush()
+        return self._search(self._connection, text, self._fts)
+
+    def search_async(self, text, callback, client=None):
+        """Search in a thread and pass the result to callback(places).
+
+        The callback runs in the main loop.  Only the result of the
+        last search requested by client is delivered, its older ones
+        in flight are interrupted.  The searches of other clients go
+        on in their own thread.
+        """
+        self.flush()
+
+        searcher = self._searchers.get(client)
+        if searcher is None:
+            searcher = _Searcher(self._db_path, self.LOCK_TIMEOUT,
+                                 self._tracer, self._search)
+            searcher.start()
+            self._searchers[client] = searcher
+        searcher.search(text, self._fts, callback)
+
+    def cancel_search(self, client=None):
+        """Drop the result of the search_async() call of client in
+        flight."""
+        if client in self._searchers:
+            self._searchers[client].cancel()
+
+    def forget_search_client(self, client):
+        """Stop the thread running the searches of client."""
+        searcher = self._searchers.pop(client, None)
+        if searcher is not None:
+            searcher.stop()
+
+    def _search(self, connection, text, fts):
+        if fts:
+            result = self._search_fts(connection, text)
+        else:
+            result = self._search_like(connection, text)
+
+        words = text.split()
+        if len(words) == 1 and len(words[0]) >= self.HOST_PREFIX_CHARS:
+            # The best place of the hosts starting with the word first.
+            hosts = [place for place, pages, frecency in
+                     self._search_hosts(connection, words[0])]
+            uris = set(place.uri for place in hosts)
+            result = hosts + [place for place in result
+                              if place.uri not in uris]
+
+        result = group_by_host(result, self.MAX_SEARCH_MATCHES)
+
+        if self._fuzzy and len(result) < self.MAX_SEARCH_MATCHES:
+            result.extend(self._search_fuzzy(connection, text, result))
+
+        return result
+
+    def _search_fts(self, connection, text):
+        # Match every word of the text as a token prefix, so 'wiki
+        # ed' finds 'http://en.wikipedia.org/wiki/Education'.
+        tokens = _TOKEN_RE.findall(text.lower())
+        if not tokens:
+            return []
+
+        # The first keys typed, like 'h' or 'www', match so many places
+        # that sorting them all would take longer than the walk.
+        # LIKE leaves out most of the places that don't match faster.
+        condition = ' and '.join(['(uri like ? or title like ?)'] *
+                                 len(tokens))
+        args = []
+        for token in tokens:
+            args.extend(['%' + token + '%'] * 2)
+        result = self._search_ranked(connection, condition +
+                                     ' and match_words(?, uri, title)',
+                                     tuple(args) + (' '.join(tokens),),
+                                     self.SEARCH_WALK)
+        if result is not None:
+            return result
+
+        query = ' '.join(['%s*' % token for token in tokens])
+        return self._search_ranked(connection,
+                                   'rowid in (select docid from places_fts '
+                                   'where places_fts match ?)', (query,))
+
+    def _search_fuzzy(self, connection, text, found):
+        """Return the places sharing most trigrams with text.
+
+        The places in found are left out.  The search stops after
+        FUZZY_BUDGET seconds and ranks what it found until then.
+        """
+        trigrams = _get_trigrams(text)
+        if len(trigrams) < 2:
+            return []
+
+        deadline = time.time() + self.FUZZY_BUDGET
+        connection.set_progress_handler(lambda: time.time() > deadline,
+                                        1000)
+        cursor = connection.cursor()
+        shared = {}
+
+        try:
+            for trigram in trigrams:
+                cursor.execute('select docid from places_trigrams '
+                               'where grams match ?', (trigram,))
+                for docid, in cursor:
+                    shared[docid] = shared.get(docid, 0) + 1
+        except sqlite3.OperationalError:
+            if time.time() <= deadline:
+                # Interrupted by a newer search.
+                raise
+            logging.debug('Fuzzy search for %r ran out of time', text)
+        finally:
+            connection.set_progress_handler(None, 1000)
+
+        least = max(2, int(len(trigrams) * self.FUZZY_SIMILARITY + 0.5))
+        candidates = [docid for docid in shared if shared[docid] >= least]
+        candidates.sort(key=shared.get, reverse=True)
+        candidates = candidates[:self.FUZZY_CANDIDATES]
+        if not candidates:
+            cursor.close()
+            return []
+
+        found = set(place.uri for place in found)
+        cursor.row_factory = _rowid_place_factory
+
+        try:
+            cursor.execute('select rowid, ' + _PLACE_COLUMNS + ' from places '
+                           'where rowid in (%s)' %
+                           ', '.join(['?'] * len(candidates)), candidates)
+            rows = [row for row in cursor if row[1].uri not in found]
+        finally:
+            cursor.close()
+
+        rows.sort(key=lambda row: (shared[row[0]],
+                                   self._get_rank(row[1])), reverse=True)
+        limit = self.MAX_SEARCH_MATCHES - len(found)
+        return [place for rowid, place in rows[:limit]]
+
+    def search_archive(self, text, limit=50):
+        """Return the archived places matching text, latest visit first.
+
+        Every word of the text has to be found in the uri or the title.
+        The archive has no search index and can be large, only call
+        this when the user asks to search the older history.
+        """
+        self.flush()
+        if self._writer is not None:
+            self._writer.wait()
+
+        words = text.split()
+        if not words:
+            return []
+
+        conditions = ' and '.join(['(uri like ? or title like ?)'] *
+                                  len(words))
+        args = []
+        for word in words:
+            args.extend(['%' + word + '%'] * 2)
+
         cursor = self._connection.cursor()
+        cursor.row_factory = _place_factory
+
+        try:
+            cursor.execute('select coalesce(uri, ""), coalesce(title, ""), '
+                           '0, 0, visits, last_visit, frecency '
+                           'from archive.places where ' + conditions +
+                           ' and uri not in (select uri from main.places) '
+                           'order by last_visit desc limit ?',
+                           args + [limit])
+
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def search_hosts(self, text):
+        """Return the best place of each host starting with text.
+
+        The result is a list of (place, pages, frecency) tuples, where
+        pages and frecency are the number of places of the host and
+        their total frecency.  A host also matches when text starts
+        its domain, the host without its first label.
+        """
+        self.flush()
+        return self._search_hosts(self._connection, text)
+
+    def _search_hosts(self, connection, text):
+        text = text.strip().lower()
+        if '://' not in text:
+            text = 'http://' + text
+        prefix = get_host(text)
+        if not prefix:
+            return []
+        start, end = _prefix_range(prefix)
+
+        cursor = connection.cursor()
 
         try:
-            text = '%' + text + '%'
-            cursor.execute('select uri, title, bookmark, gecko_flags, '
-                           'visits, last_visit from places '
-                           'where uri like ? or title like ? '
-                           'order by visits desc limit 0, ?',
-                           (text, text, self.MAX_SEARCH_MATCHES))
+            cursor.execute('select host, count(*), sum(frecency) '
+                           'from places where host in ('
+                           'select host from places where host >= ? '
+                           'and host < ? union select host from places '
+                           'where domain >= ? and domain < ?) '
+                           'group by host order by max(frecency) desc '
+                           'limit ?', (start, end, start, end,
+                                       self.MAX_SEARCH_MATCHES))
+            hosts = cursor.fetchall()
 
-            result = [self._place_from_row(row) for row in cursor]
+            cursor.row_factory = _place_factory
+            result = []
+            for host, pages, frecency in hosts:
+                cursor.execute('select ' + _PLACE_COLUMNS + ' from places '
+                               'where host=? order by frecency desc '
+                               'limit 1', (host,))
+                result.append((cursor.fetchone(), pages, frecency))
         finally:
             cursor.close()
 
         return result
 
-    def add_place(self, place):
+    def _search_like(self, connection, text):
+        text = '%' + text + '%'
+        return self._search_ranked(connection,
+                                   '(uri like ? or title like ?)',
+                                   (text, text))
+
+    def _search_ranked(self, connection, condition, args, walk=None):
+        """Return the SEARCH_CANDIDATES places matching condition with
+        the highest rank.
+
+        Ordering by the boosted frecency can't use places_frecency, so
+        the best places and the best bookmarks are read apart, each
+        along an index, and merged here.  A rank is never lower than
+        the frecency, so no place of the result is missed.
+
+        With walk, only the walk places with the highest frecency are
+        looked at, and None is returned unless they hold enough
+        matches.
+        """
+        cursor = connection.cursor()
+        cursor.row_factory = _place_factory
+
+        try:
+            if walk is None:
+                cursor.execute('select ' + _PLACE_COLUMNS + ' from places '
+                               'where ' + condition + ' '
+                               'order by frecency desc limit 0, ?',
+                               args + (self.SEARCH_CANDIDATES,))
+            else:
+                cursor.execute('select ' + _PLACE_COLUMNS + ' from '
+                               '(select * from places '
+                               'order by frecency desc limit 0, ?) '
+                               'where ' + condition + ' limit 0, ?',
+                               (walk,) + args +
+                               (self.SEARCH_CANDIDATES,))
+            result = cursor.fetchall()
+            if walk is not None and \
+                    len(result) < self.MAX_SEARCH_MATCHES:
+                return None
+
+            cursor.execute('select ' + _PLACE_COLUMNS + ' from places '
+                           'where bookmark=1 and ' + condition + ' '
+                           'order by frecency desc limit 0, ?',
+                           args + (self.SEARCH_CANDIDATES,))
+            found = set(place.uri for place in result)
+            result.extend(place for place in cursor.fetchall()
+                          if place.uri not in found)
+        finally:
+            cursor.close()
+
+        result.sort(key=self._get_rank, reverse=True)
+        return result[:self.SEARCH_CANDIDATES]
+
+    def _notify(self, signal, changes):
+        if not changes:
+            return
+        if self._changes_sid is None:
+            self._changes_sid = GObject.idle_add(self.__notify_idle_cb)
+        self._changes.setdefault(signal, []).extend(changes)
+
+    def __notify_idle_cb(self):
+        changes = self._changes
+        self._changes = {}
+        self._changes_sid = None
+        for signal in self.SIGNALS:
+            if signal in changes:
+                self.emit(signal, changes[signal])
+        return False
+
+    def _get_rank(self, place):
+        if place.bookmark:
+            return (place.frecency or 0) * self.BOOKMARK_BOOST
+        return place.frecency or 0
+
+    def _load_bookmarks(self):
         cursor = self._connection.cursor()
 
         try:
-            cursor.execute('insert into places (uri, title, bookmark, '
-                           'gecko_flags, visits, last_visit) '
-                           'values (?, ?, ?, ?, ?, ?)',
-                           (place.uri, place.title, place.bookmark,
-                            place.gecko_flags, place.visits, place.last_visit))
-            self._connection.commit()
+            cursor.execute('select uri from places where bookmark=1')
+            self._bookmarks = set(row[0] for row in cursor)
+        finally:
+            cursor.close()
+
+    def _set_bookmarked(self, uri, bookmarked):
+        if (uri in self._bookmarks) == bool(bookmarked):
+            return
+        if bookmarked:
+            self._bookmarks.add(uri)
+        else:
+            self._bookmarks.discard(uri)
+        self._notify('bookmark-changed', [(uri, bool(bookmarked))])
+
+    def add_bookmark(self, uri, title=''):
+        """Bookmark uri, adding a new place if it is unknown."""
+        self._set_bookmarked(uri, True)
+        self._queue_write(self._write_bookmark, uri, title, True)
+
+    def remove_bookmark(self, uri):
+        self._set_bookmarked(uri, False)
+        self._queue_write(self._write_bookmark, uri, '', False)
+
+    def is_bookmarked(self, uri):
+        """Return whether uri is bookmarked, without touching places.db."""
+        return uri in self._bookmarks
+
+    def get_bookmarks(self):
+        """Return the bookmarked places, most frecent first."""
+        self.flush()
+        if self._writer is not None:
+            self._writer.wait()
+
+        cursor = self._connection.cursor()
+        cursor.row_factory = _place_factory
+
+        try:
+            cursor.execute('select ' + _PLACE_COLUMNS + ' from places '
+                           'where bookmark=1 order by frecency desc')
+
+            return cursor.fetchall()
         finally:
             cursor.close()
 
+    def add_place(self, place):
+        if place.bookmark:
+            self._set_bookmarked(place.uri, True)
+        last_visit = _to_epoch(place._last_visit)
+        frecency = (place.visits + 1) * frecency_boost(last_visit)
+        self._queue_write(self._write_add_place, place.uri, place.title,
+                          place.bookmark, place.gecko_flags, place.visits,
+                          last_visit, frecency)
+
+    def record_visit(self, uri, date=None, visit_type=VISIT_LINK):
+        """Count a visit to uri, adding a new place if it is unknown."""
+        if date is None:
+            date = datetime.now()
+        date = _to_epoch(date)
+        self._queue_write(self._write_visit, uri, date, visit_type,
+                          frecency_boost(date, visit_type))
+        self._notify('visit-added', [(uri, visit_type)])
+
+    def set_title(self, uri, title):
+        self._queue_write(self._write_title, uri, title)
+        self._notify('title-changed', [(uri, title)])
+
     def lookup_place(self, uri):
+        self.flush()
+        if self._writer is not None:
+            self._writer.wait()
+
         cursor = self._connection.cursor()
+        cursor.row_factory = _place_factory
 
         try:
-            cursor.execute('select uri, title, bookmark, gecko_flags,visits, '
-                           'last_visit from places where uri=?', (uri,))
+            cursor.execute('select ' + _PLACE_COLUMNS + ' from places '
+                           'where uri=?', (uri,))
 
-            row = cursor.fetchone()
-            if row:
-                return self._place_from_row(row)
-            else:
-                return None
+            return cursor.fetchone()
         finally:
             cursor.close()
 
-    def update_place(self, place):
+    def count_places(self):
+        self.flush()
+
         cursor = self._connection.cursor()
 
         try:
-            cursor.execute('update places set title=?, gecko_flags=?, '
-                           'visits=?, last_visit=?, bookmark=? where uri=?',
-                           (place.title, place.gecko_flags, place.visits,
-                            place.last_visit, place.bookmark, place.uri))
-            self._connection.commit()
+            cursor.execute('select count(*) from places')
+            return cursor.fetchone()[0]
         finally:
             cursor.close()
 
-    def _place_from_row(self, row):
-        place = Place()
+    def get_places(self, after, limit):
+        """Return up to limit (rowid, place) pairs with rowid > after.
+
+        Pass the last rowid returned to get the next page, this keeps
+        working when the places table changes between the calls.
+        """
+        self.flush()
+
+        cursor = self._connection.cursor()
+        cursor.row_factory = _rowid_place_factory
 
-        # Return uri and title as empty strings instead of None.
-        # Previous versions of Browse were allowing to store None for
-        # those fields in the places database.  See ticket #3400 .
-        if row[0] is None:
-            row = tuple([''] + list(row[1:]))
-        if row[1] is None:
-            row = tuple([row[0], ''] + list(row[2:]))
+        try:
+            cursor.execute('select rowid, ' + _PLACE_COLUMNS + ' from places '
+                           'where rowid > ? order by rowid limit ?',
+                           (after, limit))
 
-        place.uri, place.title, place.bookmark, place.gecko_flags, \
-            place.visits, place.last_visit = row
+            result = cursor.fetchall()
+        finally:
+            cursor.close()
 
-        return place
+        return result
+
+    def get_places_by_day(self, day):
+        """Return the places visited on day, a date, latest visit first."""
+        self.flush()
+        if self._writer is not None:
+            self._writer.wait()
+
+        start = _to_epoch(day)
+        end = _to_epoch(day + timedelta(days=1))
 
-    def _cleanup(self):
         cursor = self._connection.cursor()
+        cursor.row_factory = _place_factory
 
         try:
-            date = datetime.now() - timedelta(days=self.EXPIRE_DAYS)
-            cursor.execute('delete from places where last_visit < ?', (date,))
-            self._connection.commit()
+            cursor.execute('select ' + _PLACE_COLUMNS + ' from places '
+                           'join (select place_id, max(visit_date) as latest '
+                           'from visits where visit_date >= ? and '
+                           'visit_date < ? group by place_id) '
+                           'on places.rowid=place_id order by latest desc',
+                           (start, end))
+
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def export_places(self, fileobj):
+        """Write the history to fileobj as JSON lines, one per place.
+
+        last_visit is written in seconds since the epoch.  Return the
+        number of places written.
+        """
+        count = 0
+        for place in self._iter_places():
+            fileobj.write(json.dumps({
+                'uri': place.uri,
+                'title': place.title,
+                'bookmark': bool(place.bookmark),
+                'gecko_flags': place.gecko_flags,
+                'visits': place.visits,
+                'last_visit': _to_epoch(place._last_visit),
+                'frecency': place.frecency}))
+            fileobj.write('\n')
+            count += 1
+        return count
+
+    def _iter_places(self):
+        after = 0
+        while True:
+            rows = self.get_places(after, self.EXPORT_CHUNK)
+            for after, place in rows:
+                yield place
+            if len(rows) < self.EXPORT_CHUNK:
+                break
+
+    def import_places(self, fileobj, merge=MERGE_SUM):
+        """Add the places of a JSON lines file written by export_places().
+
+        Places are inserted IMPORT_CHUNK at a time, and committed every
+        IMPORT_TRANSACTION places.  Into an empty history they are
+        imported in one transaction, building the indexes at the end
+        and not as they are inserted.  merge tells what to do with the
+        places already in the history, see MERGE_SKIP, MERGE_REPLACE
+        and MERGE_SUM.  Only the last visit of each place is logged
+        in visits.  Return the number of places read.
+        """
+        self.flush()
+        if self._writer is not None:
+            self._writer.wait()
+
+        update = _MERGE_UPDATES.get(merge)
+        count = 0
+        chunk = []
+        # Let us control the transactions, the sqlite3 module commits
+        # before any statement changing the schema otherwise.
+        self._connection.isolation_level = None
+        cursor = self._connection.cursor()
+
+        try:
+            cursor.execute('begin immediate')
+            cursor.execute('select exists (select * from places)')
+            if cursor.fetchone()[0]:
+                indexes = None
+            else:
+                indexes = self._drop_import_indexes(cursor)
+
+            if self._fts_table:
+                self._defer_search_index(cursor)
+
+            for row in _read_places(fileobj):
+                chunk.append(row)
+                if len(chunk) < self.IMPORT_CHUNK:
+                    continue
+
+                self._import_chunk(cursor, chunk, update, indexes is None)
+                count += len(chunk)
+                chunk = []
+                # Without its indexes the history has to be imported
+                # in a single transaction.
+                if count % self.IMPORT_TRANSACTION == 0 and \
+                        indexes is None:
+                    cursor.execute('commit')
+                    cursor.execute('begin immediate')
+
+            self._import_chunk(cursor, chunk, update, indexes is None)
+            count += len(chunk)
+
+            if indexes is not None:
+                # The history was empty, log all the visits at once.
+                cursor.execute('insert into visits (place_id, visit_date, '
+                               'transition) select rowid, last_visit, ? '
+                               'from places where visits > 0',
+                               (VISIT_LINK,))
+                for sql in indexes:
+                    cursor.execute(sql)
+            if self._fts_table:
+                cursor.execute('update backfills set last=(select '
+                               'max(rowid) from places) where version=?',
+                               (_FTS_VERSION,))
+            cursor.execute('commit')
+        except:
+            self._connection.rollback()
+            raise
+        finally:
+            cursor.close()
+            self._connection.isolation_level = ''
+
+        if self._fts_table and _FTS_VERSION not in self._backfills:
+            self._backfills.append(_FTS_VERSION)
+            self._backfills.sort()
+            self._update_schema_state()
+            self._start_backfills()
+        self._start_trigrams()
+
+        bookmarks = self._bookmarks
+        self._load_bookmarks()
+        self._notify('bookmark-changed',
+                     [(uri, True) for uri in self._bookmarks - bookmarks])
+
+        logging.debug('Imported %d places', count)
+        return count
+
+    def _drop_import_indexes(self, cursor):
+        """Drop the indexes an import into an empty history can build
+        at the end, and return the statements creating them again.
+
+        Creating an index from the whole table is much faster than
+        updating it for each place.  places_uri stays, the import
+        needs it to skip the places read twice.
+        """
+        cursor.execute('select name, sql from sqlite_master '
+                       'where type="index" and tbl_name in ("places", '
+                       '"visits") and sql is not null and name!=?',
+                       ('places_uri',))
+        indexes = cursor.fetchall()
+        for name, sql in indexes:
+            cursor.execute('drop index %s' % name)
+        return [sql for name, sql in indexes]
+
+    def _defer_search_index(self, cursor):
+        """Leave the places added from now on to the index backfill.
+
+        Indexing the places as they are inserted is what makes large
+        imports slow.  The search index triggers skip the places in the
+        range of its backfill, which is left open until the import is
+        done.
+        """
+        cursor.execute('select max(rowid) from places')
+        first = cursor.fetchone()[0] or 0
+        cursor.execute('insert or ignore into backfills (version, '
+                       'position, last) values (?, ?, 0)',
+                       (_FTS_VERSION, first))
+        cursor.execute('update backfills set last=? where version=?',
+                       (_MAX_ROWID, _FTS_VERSION))
+
+    def _import_chunk(self, cursor, chunk, update, log_visits):
+        # Update the places that exist first, so that the insert only
+        # adds the new ones.
+        if update is not None:
+            cursor.executemany(update, [row[1:] + row[:1] for row in chunk])
+            if log_visits:
+                cursor.executemany(_LOG_LAST_VISIT,
+                                   [(VISIT_LINK, row[0]) for row in chunk])
+        if log_visits:
+            cursor.execute('select max(rowid) from places')
+            first = cursor.fetchone()[0] or 0
+        cursor.executemany('insert or ignore into places (uri, title, '
+                           'bookmark, gecko_flags, visits, last_visit, '
+                           'frecency, host, domain) '
+                           'values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           [row + _split_uri(row[0]) for row in chunk])
+        if log_visits:
+            # The places just added have no visits logged yet.
+            cursor.execute('insert into visits (place_id, visit_date, '
+                           'transition) select rowid, last_visit, ? '
+                           'from places where rowid > ? and visits > 0',
+                           (VISIT_LINK, first))
+
+    def update_place(self, place):
+        self._set_bookmarked(place.uri, place.bookmark)
+        self._queue_write(self._write_update_place, place.uri, place.title,
+                          place.bookmark, place.gecko_flags, place.visits,
+                          _to_epoch(place._last_visit))
+
+    def get_queue_depth(self):
+        """Return the number of writes not committed yet."""
+        depth = len(self._pending)
+        if self._writer is not None:
+            depth += self._writer.get_queue_depth()
+        return depth
+
+    def flush(self):
+        """Write all the queued changes in a single transaction.
+
+        In WAL mode the transaction is handed to the writer thread and
+        may not be committed yet when this returns.
+        """
+        if self._flush_sid is not None:
+            GObject.source_remove(self._flush_sid)
+            self._flush_sid = None
+
+        if not self._pending:
+            return
+
+        pending = self._pending
+        self._pending = []
+
+        # Index the places changed by this batch, unless the trigram
+        # index is catching up.
+        if self._fuzzy and self._trigram_sid is None:
+            pending.append((self._write_trigrams,
+                            (self.TRIGRAM_CHUNK, None)))
+
+        if self._writer is not None:
+            self._writer.write(pending)
+        else:
+            _write_batch(self._connection, pending)
+
+    def close(self):
+        """Write the queued changes and close the database."""
+        if self._changes_sid is not None:
+            GObject.source_remove(self._changes_sid)
+            self._changes_sid = None
+        if self._maintenance_sid is not None:
+            GObject.source_remove(self._maintenance_sid)
+            self._maintenance_sid = None
+            self._maintenance = None
+        # The backfills go on from where they are when opened again.
+        if self._backfill_sid is not None:
+            GObject.source_remove(self._backfill_sid)
+            self._backfill_sid = None
+        if self._trigram_sid is not None:
+            GObject.source_remove(self._trigram_sid)
+            self._trigram_sid = None
+        self.flush()
+        for searcher in self._searchers.values():
+            searcher.stop()
+        self._searchers = {}
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+        if self._convert_at_close:
+            self._convert(self._connection, _Step())
+        self._connection.close()
+
+        if self._tracer is not None:
+            logging.debug(self.get_trace_summary())
+
+    def _queue_write(self, write, *args):
+        self._pending.append((write, args))
+
+        if len(self._pending) >= self.WRITE_BATCH_SIZE:
+            self.flush()
+        elif self._flush_sid is None:
+            self._flush_sid = GObject.timeout_add_seconds(
+                self.WRITE_INTERVAL, self.__flush_timeout_cb)
+
+    def __flush_timeout_cb(self):
+        self._flush_sid = None
+        self.flush()
+        return False
+
+    def _write_add_place(self, cursor, uri, title, bookmark, gecko_flags,
+                         visits, last_visit, frecency):
+        cursor.execute('insert into places (uri, title, bookmark, '
+                       'gecko_flags, visits, last_visit, frecency, host, '
+                       'domain) values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (uri, title, bookmark, gecko_flags, visits,
+                        last_visit, frecency) + _split_uri(uri))
+        cursor.execute(_LOG_LAST_VISIT, (VISIT_LINK, uri))
+
+    def _write_visit(self, cursor, uri, date, visit_type, boost):
+        # Update the rollup of the place, then log the visit.
+        if _HAVE_UPSERT:
+            cursor.execute('insert into places (uri, title, bookmark, '
+                           'gecko_flags, visits, last_visit, frecency, '
+                           'host, domain) '
+                           'values (?, "", 0, 0, 0, ?, ?, ?, ?) '
+                           'on conflict (uri) do update set '
+                           'visits=visits + 1, '
+                           'last_visit=excluded.last_visit, '
+                           'frecency=coalesce(frecency, 0) + '
+                           'excluded.frecency',
+                           (uri, date, boost) + _split_uri(uri))
+        else:
+            cursor.execute('insert or ignore into places (uri, title, '
+                           'bookmark, gecko_flags, visits, last_visit, '
+                           'frecency, host, domain) '
+                           'values (?, "", 0, 0, 0, ?, ?, ?, ?)',
+                           (uri, date, boost) + _split_uri(uri))
+            if cursor.rowcount == 0:
+                cursor.execute('update places set visits=visits + 1, '
+                               'last_visit=?, '
+                               'frecency=coalesce(frecency, 0) + ? '
+                               'where uri=?', (date, boost, uri))
+
+        cursor.execute('insert into visits (place_id, visit_date, '
+                       'transition) select rowid, ?, ? from places '
+                       'where uri=?', (date, visit_type, uri))
+
+    def _write_bookmark(self, cursor, uri, title, bookmark):
+        if bookmark:
+            cursor.execute('insert or ignore into places (uri, title, '
+                           'bookmark, gecko_flags, visits, last_visit, '
+                           'frecency, host, domain) '
+                           'values (?, ?, 1, 0, 0, ?, 0, ?, ?)',
+                           (uri, title, int(time.time())) + _split_uri(uri))
+        cursor.execute('update places set bookmark=?, '
+                       'title=coalesce(nullif(title, ""), ?) where uri=?',
+                       (int(bookmark), title, uri))
+
+    def _write_title(self, cursor, uri, title):
+        cursor.execute('update places set title=? where uri=?',
+                       (title, uri))
+
+    def _write_update_place(self, cursor, uri, title, bookmark, gecko_flags,
+                            visits, last_visit):
+        cursor.execute('update places set title=?, gecko_flags=?, '
+                       'visits=?, last_visit=?, bookmark=? where uri=?',
+                       (title, gecko_flags, visits, last_visit, bookmark,
+                        uri))
+        cursor.execute(_LOG_LAST_VISIT, (VISIT_LINK, uri))
+
+    def start_expiry(self):
+        """Evict places until the history fits its bounds, a chunk at a
+        time.
+
+        The places with the lowest frecency go first, to the archive,
+        bookmarks are kept.  The visits older than EXPIRE_DAYS are
+        pruned in the same chunks, and the freed pages are given back
+        to the file system.  The uris removed by each chunk are
+        announced by places-expired.
+        """
+        if self._expiry is not None:
+            return
+
+        cutoff = _to_epoch(datetime.now() - timedelta(days=self.EXPIRE_DAYS))
+        self._expiry = _Expiry(cutoff)
+        GObject.timeout_add(self.EXPIRE_INTERVAL, self.__expire_timeout_cb)
+
+    def get_expiry_stats(self):
+        """Return the places deleted by the last expiry, the seconds spent
+        deleting them and the seconds the expiry took, or None."""
+        return self._expiry_stats
+
+    def __expire_timeout_cb(self):
+        expiry = self._expiry
+
+        if expiry.step is not None:
+            if not expiry.step:
+                # The writer thread didn't get to it yet.
+                return True
+
+            if expiry.step[0] is _FAILED:
+                if not self._retry_step(expiry.step, 'expire places'):
+                    self._expiry = None
+                    return False
+                self._queue_write(self._write_expire, expiry.cutoff,
+                                  self.EXPIRE_CHUNK, expiry.excess,
+                                  expiry.step)
+                self.flush()
+                return True
+
+            uris, pruned, expiry.excess, duration = expiry.step[0]
+            expiry.step = None
+            expiry.deleted += len(uris)
+            expiry.pruned += pruned
+            expiry.duration += duration
+            if uris:
+                self._notify('places-expired', uris)
+
+            if len(uris) < self.EXPIRE_CHUNK and \
+                    pruned < self.EXPIRE_CHUNK:
+                self._expiry = None
+                self._expiry_stats = (expiry.deleted, expiry.duration,
+                                      time.time() - expiry.start)
+                logging.info('Expired %d places in %.3f seconds, '
+                             '%.1f seconds elapsed', *self._expiry_stats)
+                logging.debug('Pruned %d visits', expiry.pruned)
+                return False
+
+        if _FRECENCY_VERSION in self._backfills:
+            # Until then the older places have no frecency, and would
+            # be evicted whatever their visits.
+            if self._backfill_sid is not None:
+                return True
+            logging.error('places.db has no frecency, not expired')
+            self._expiry = None
+            return False
+
+        expiry.step = _Step()
+        self._queue_write(self._write_expire, expiry.cutoff,
+                          self.EXPIRE_CHUNK, expiry.excess, expiry.step)
+        self.flush()
+        return True
+
+    def _count_excess(self, cursor):
+        """Return the number of places to evict to fit the bounds."""
+        cursor.execute('select count(*) from places')
+        count = cursor.fetchone()[0]
+        excess = max(0, count - self.MAX_PLACES)
+
+        cursor.execute('pragma page_count')
+        pages = cursor.fetchone()[0]
+        cursor.execute('pragma freelist_count')
+        pages -= cursor.fetchone()[0]
+        cursor.execute('pragma page_size')
+        used = pages * cursor.fetchone()[0]
+        if used > self.MAX_BYTES and count:
+            # Assume that every place takes the same room.
+            excess = max(excess, (used - self.MAX_BYTES) * count / used + 1)
+
+        return excess
+
+    def _archive(self, cursor, rowids):
+        # A place visited again after it was archived is merged with
+        # its archived row.
+        if _HAVE_UPSERT:
+            cursor.executemany('insert into archive.places '
+                               'select uri, title, visits, last_visit, '
+                               'frecency from main.places where rowid=? '
+                               'and uri is not null '
+                               'on conflict (uri) do update set '
+                               'title=coalesce(nullif(excluded.title, ""), '
+                               'title), '
+                               'visits=coalesce(visits, 0) + '
+                               'coalesce(excluded.visits, 0), '
+                               'last_visit=max(coalesce(last_visit, 0), '
+                               'coalesce(excluded.last_visit, 0)), '
+                               'frecency=coalesce(frecency, 0) + '
+                               'coalesce(excluded.frecency, 0)', rowids)
+            return
+
+        for rowid, in rowids:
+            cursor.execute('select uri, title, visits, last_visit, '
+                           'frecency from main.places where rowid=? '
+                           'and uri is not null', (rowid,))
+            row = cursor.fetchone()
+            if row is None:
+                continue
+            uri, title, visits, last_visit, frecency = row
+            cursor.execute('update archive.places set '
+                           'title=coalesce(nullif(?, ""), title), '
+                           'visits=coalesce(visits, 0) + ?, '
+                           'last_visit=max(coalesce(last_visit, 0), ?), '
+                           'frecency=coalesce(frecency, 0) + ? '
+                           'where uri=?',
+                           (title, visits or 0, last_visit or 0,
+                            frecency or 0, uri))
+            if cursor.rowcount == 0:
+                cursor.execute('insert into archive.places (uri, title, '
+                               'visits, last_visit, frecency) '
+                               'values (?, ?, ?, ?, ?)', row)
+
+    def _trim_archive(self, cursor):
+        cursor.execute('select count(*) from archive.places')
+        excess = cursor.fetchone()[0] - self.ARCHIVE_MAX_PLACES
+        if excess > 0:
+            cursor.execute('delete from archive.places where rowid in '
+                           '(select rowid from archive.places '
+                           'order by last_visit limit ?)', (excess,))
+
+    def _write_expire(self, cursor, cutoff, limit, excess, step):
+        start = time.time()
+        uris = []
+        pruned = 0
+        try:
+            cursor.execute('delete from visits where rowid in (select '
+                           'rowid from visits where visit_date < ? '
+                           'limit ?)', (cutoff, limit))
+            pruned = cursor.rowcount
+
+            if excess is None:
+                excess = self._count_excess(cursor)
+                self._trim_archive(cursor)
+
+            cursor.execute('select rowid, uri from places '
+                           'where not coalesce(bookmark, 0) '
+                           'order by frecency limit ?',
+                           (min(limit, excess),))
+            rows = cursor.fetchall()
+            rowids = [(rowid,) for rowid, uri in rows]
+            self._archive(cursor, rowids)
+            cursor.executemany('delete from places where rowid=?', rowids)
+            uris = [uri for rowid, uri in rows]
+            excess -= len(rows)
+
+            if rows or pruned:
+                # Only shrinks the file when auto_vacuum is
+                # incremental, see __init__().
+                cursor.execute('pragma incremental_vacuum')
+                cursor.fetchall()
+        finally:
+            step.append((uris, pruned, excess, time.time() - start))
+
+    def start_maintenance(self):
+        """Run the maintenance jobs that are due, a step at a time.
+
+        The jobs give the free pages back to the file system, merge the
+        full-text indexes, refresh the statistics of the query planner
+        and check the database.  Steps wait while the store is busy, and
+        the run stops when the machine goes on battery.
+        """
+        if self._maintenance is not None or _on_battery():
+            return
+
+        cursor = self._connection.cursor()
+        try:
+            cursor.execute('select job, last_run from maintenance')
+            last_runs = dict(cursor.fetchall())
+            cursor.execute('pragma auto_vacuum')
+            incremental = cursor.fetchone()[0] == 2
         finally:
             cursor.close()
 
+        now = time.time()
+        jobs = [job for job, days in self.MAINTENANCE_JOBS
+                if now - last_runs.get(job, 0) >= days * 24 * 60 * 60]
+        if not incremental and 'vacuum' in jobs and self._writer is None:
+            # Switching older files to auto_vacuum takes a VACUUM of the
+            # whole file.  The writer thread runs it in WAL mode, the
+            # main loop can't wait for it, so it is left to close().
+            logging.debug('places.db will be vacuumed when closed')
+            self._convert_at_close = True
+            jobs.remove('vacuum')
+        if not jobs:
+            return
+
+        self._unchecked = None
+        self._maintenance = _Maintenance(jobs, not incremental,
+                                         self._get_file_size())
+        logging.info('Maintaining places.db (%s), %d bytes',
+                     ', '.join(jobs), self._maintenance.size)
+        self._maintenance_sid = GObject.timeout_add(
+            self.MAINTENANCE_INTERVAL, self.__maintenance_timeout_cb)
+
+    def _get_file_size(self):
+        size = 0
+        for path in [self._db_path, self._db_path + '-wal']:
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+        return size
+
+    def _is_busy(self):
+        if self._pending or self._expiry is not None or \
+                self._backfill_sid is not None or \
+                self._trigram_sid is not None:
+            return True
+        return os.getloadavg()[0] > self.MAINTENANCE_MAX_LOAD
+
+    def __maintenance_timeout_cb(self):
+        maintenance = self._maintenance
+
+        if maintenance.step is not None:
+            if not maintenance.step:
+                # The writer thread didn't get to it yet.
+                return True
+
+            if maintenance.step[0] is _FAILED:
+                if self._retry_step(maintenance.step,
+                                    'run ' + maintenance.jobs[0]):
+                    return self._queue_maintenance()
+                maintenance.step[:] = [(None, 0.0)]
+
+            finished, duration = maintenance.step[0]
+            maintenance.step = None
+            maintenance.duration += duration
+            if finished is None:
+                logging.error('Maintenance job %s of places.db failed',
+                              maintenance.jobs.pop(0))
+            elif finished:
+                logging.debug('Maintenance job %s took %.3f seconds',
+                              maintenance.jobs.pop(0), maintenance.duration)
+            if finished is not False:
+                maintenance.duration = 0.0
+
+        if not maintenance.jobs:
+            if self._writer is not None:
+                self._checkpoint()
+            logging.info('Maintained places.db in %.1f seconds, %d bytes, '
+                         'was %d bytes', time.time() - maintenance.start,
+                         self._get_file_size(), maintenance.size)
+            self._maintenance = None
+            self._maintenance_sid = None
+            return False
+
+        if _on_battery():
+            logging.debug('On battery, maintenance of places.db postponed')
+            self._maintenance = None
+            self._maintenance_sid = None
+            return False
+
+        if self._is_busy():
+            return True
+
+        maintenance.step = _Step()
+        if maintenance.jobs[0] == 'vacuum' and maintenance.convert:
+            maintenance.convert = False
+            self._writer.call(self._convert, maintenance.step)
+            return True
+        return self._queue_maintenance()
+
+    def _queue_maintenance(self):
+        maintenance = self._maintenance
+        self._queue_write(self._write_maintenance, maintenance.jobs[0],
+                          maintenance.duration, maintenance.step)
+        self.flush()
+        return True
+
+    def _convert(self, connection, step):
+        """Rebuild places.db, for auto_vacuum=incremental to apply.
+
+        Only needed once by files created by older versions.  VACUUM
+        can't run in a transaction.  Append (finished, duration) to
+        step, the vacuum job goes on with its usual steps.
+        """
+        start = time.time()
+        finished = None
+        connection.isolation_level = None
+        try:
+            connection.execute('pragma main.auto_vacuum=incremental')
+            connection.execute('vacuum')
+            finished = False
+            logging.info('Vacuumed places.db in %.1f seconds',
+                         time.time() - start)
+        except sqlite3.Error:
+            logging.exception('Could not vacuum places.db')
+        finally:
+            connection.isolation_level = ''
+            step.append((finished, time.time() - start))
+
+    def _checkpoint(self):
+        # Copy the log back into places.db and empty it, otherwise
+        # the pages freed stay in the log.
+        self._writer.wait()
+        try:
+            self._connection.execute('pragma wal_checkpoint(truncate)')
+        except sqlite3.Error:
+            logging.exception('Could not checkpoint places.db')
+
+    def _write_maintenance(self, cursor, job, duration, step):
+        start = time.time()
+        finished = None
+        try:
+            finished = getattr(self, '_maintain_' + job)(cursor)
+            if finished:
+                cursor.execute('insert or replace into maintenance '
+                               '(job, last_run, duration) values (?, ?, ?)',
+                               (job, int(time.time()),
+                                duration + time.time() - start))
+        finally:
+            step.append((finished, time.time() - start))
+
+    def _maintain_vacuum(self, cursor):
+        cursor.execute('pragma incremental_vacuum(%d)' % self.VACUUM_PAGES)
+        cursor.fetchall()
+        cursor.execute('pragma freelist_count')
+        return cursor.fetchone()[0] == 0
+
+    def _maintain_optimize(self, cursor):
+        # A merge changing less than two rows has nothing left to do,
+        # see http://www.sqlite.org/fts3.html#*fts4mergecmd
+        tables = []
+        if self._fts_table:
+            tables.append('places_fts')
+        if self._fuzzy:
+            tables.append('places_trigrams')
+
+        finished = True
+        for table in tables:
+            changes = cursor.connection.total_changes
+            cursor.execute('insert into %s (%s) values ("merge=%d,8")' %
+                           (table, table, self.FTS_MERGE_PAGES))
+            if cursor.connection.total_changes - changes >= 2:
+                finished = False
+        return finished
+
+    def _maintain_analyze(self, cursor):
+        # analysis_limit is ignored before SQLite 3.32, ANALYZE then
+        # reads the whole indexes.
+        cursor.execute('pragma analysis_limit=%d' % self.ANALYZE_LIMIT)
+        cursor.fetchall()
+        cursor.execute('analyze main')
+        return True
+
+    def _maintain_check(self, cursor):
+        # A step checks a table and its indexes, older versions of
+        # SQLite check the whole file at once.
+        if not _HAVE_CHECK_TABLE:
+            self._check(cursor, 'pragma main.quick_check')
+            return True
+
+        if self._unchecked is None:
+            cursor.execute('select name from main.sqlite_master '
+                           'where type="table" and rootpage>0')
+            self._unchecked = [row[0] for row in cursor.fetchall()]
+        if self._unchecked:
+            table = self._unchecked.pop()
+            self._check(cursor, 'pragma main.quick_check("%s")' % table)
+        return not self._unchecked
+
+    def _check(self, cursor, query):
+        cursor.execute(query)
+        errors = [row[0] for row in cursor.fetchall() if row[0] != 'ok']
+        if errors:
+            logging.error('places.db is damaged: %s', '; '.join(errors))
+
 
 def get_store():
     global _store
     if _store is None:
-        _store = SqliteStore()
+        _store = SqliteStore(wal=_USE_WAL, fuzzy=_USE_FUZZY,
+                             trace=_USE_TRACE)
+        atexit.register(_store.close)
     return _store
@@ -0,0 +1,217 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Upgrade a places.db made by older versions of Browse.
+
+Run it from the activity directory, without Sugar or a display:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import StringIO
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+_activity_root = None
+
+
+def _get_activity_root():
+    return _activity_root
+
+
+def _stub_sugar():
+    # places only needs the activity root from Sugar.
+    for name in ['sugar3', 'sugar3.activity', 'sugar3.activity.activity']:
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules['sugar3'].activity = sys.modules['sugar3.activity']
+    sys.modules['sugar3.activity'].activity = \
+        sys.modules['sugar3.activity.activity']
+    sys.modules['sugar3.activity.activity'].get_activity_root = \
+        _get_activity_root
+
+
+_stub_sugar()
+
+from gi.repository import GLib
+
+import places
+
+# The places of a places.db made before the migrations: uri, title,
+# visits and last visit, in local time.
+_BASELINE_PLACES = [
+    (u'http://sugarlabs.org/', u'', 2, '2026-01-02 10:00:00'),
+    (u'http://sugarlabs.org/', u'Sugar Labs', 3, '2026-01-05 08:30:00'),
+    (u'http://wiki.sugarlabs.org/go/Activities', u'Activities', 1,
+     '2026-01-03 12:00:00'),
+    (None, u'No uri', 1, '2026-01-04 09:00:00'),
+    (u'http://sugarlabs.org/', None, 1, '2026-01-01 18:00:00'),
+]
+
+
+def _to_seconds(local_time):
+    return int(time.mktime(time.strptime(local_time, '%Y-%m-%d %H:%M:%S')))
+
+
+def _run_main_loop(done, timeout=30):
+    context = GLib.MainContext.default()
+    deadline = time.time() + timeout
+    while not done() and time.time() < deadline:
+        context.iteration(False)
+        time.sleep(0.001)
+
+
+class _BaselineTest(unittest.TestCase):
+    """Open a SqliteStore on a places.db holding BASELINE_PLACES."""
+
+    BASELINE_PLACES = _BASELINE_PLACES
+
+    def setUp(self):
+        global _activity_root
+        _activity_root = tempfile.mkdtemp(prefix='test-places-')
+        os.mkdir(os.path.join(_activity_root, 'data'))
+
+        connection = sqlite3.connect(os.path.join(_activity_root, 'data',
+                                                  'places.db'))
+        connection.execute('create table places (uri text, title text, '
+                           'bookmark boolean, gecko_flags integer, '
+                           'visits integer, last_visit timestamp)')
+        connection.executemany('insert into places (uri, title, bookmark, '
+                               'gecko_flags, visits, last_visit) '
+                               'values (?, ?, 0, 0, ?, ?)',
+                               self.BASELINE_PLACES)
+        connection.commit()
+        connection.close()
+
+        self._store = places.SqliteStore()
+
+    def tearDown(self):
+        self._store.close()
+        shutil.rmtree(_activity_root)
+
+    def _backfill(self):
+        _run_main_loop(lambda: self._store._backfill_sid is None)
+        self.assertEqual(self._store._backfills, [])
+
+    def _fetch(self, query, *args):
+        return self._store._connection.execute(query, args).fetchall()
+
+
+class MigrationTest(_BaselineTest):
+
+    def test_user_version(self):
+        self.assertEqual(self._fetch('pragma user_version'),
+                         [(len(places._MIGRATIONS),)])
+
+    def test_duplicates_merged(self):
+        rows = self._fetch('select title, visits, last_visit from places '
+                           'where uri=?', u'http://sugarlabs.org/')
+        self.assertEqual(rows, [(u'Sugar Labs', 6, '2026-01-05 08:30:00')])
+        self.assertEqual(self._fetch('select count(*) from places'),
+                         [(3,)])
+
+    def test_backfills(self):
+        self._backfill()
+        self.assertEqual(self._fetch('select * from backfills'), [])
+
+        rows = self._fetch('select uri, last_visit, frecency, host, domain '
+                           'from places where uri is not null order by uri')
+        self.assertEqual(
+            [row[:2] + row[3:] for row in rows],
+            [(u'http://sugarlabs.org/', _to_seconds('2026-01-05 08:30:00'),
+              u'sugarlabs.org', None),
+             (u'http://wiki.sugarlabs.org/go/Activities',
+              _to_seconds('2026-01-03 12:00:00'), u'wiki.sugarlabs.org',
+              u'sugarlabs.org')])
+        for row in rows:
+            self.assertTrue(row[2] > 0)
+
+        # The place without uri keeps its visit, converted too.
+        self.assertEqual(self._fetch('select typeof(last_visit) from places '
+                                     'where uri is null'), [(u'integer',)])
+        self.assertEqual(
+            self._fetch('select places.uri, visit_date, transition '
+                        'from visits join places on place_id=places.rowid '
+                        'where uri is not null order by uri'),
+            [(u'http://sugarlabs.org/', _to_seconds('2026-01-05 08:30:00'),
+              places.VISIT_LINK),
+             (u'http://wiki.sugarlabs.org/go/Activities',
+              _to_seconds('2026-01-03 12:00:00'), places.VISIT_LINK)])
+
+    def test_search_after_backfill(self):
+        self._backfill()
+        self.assertEqual([place.uri for place in
+                          self._store.search(u'activ')],
+                         [u'http://wiki.sugarlabs.org/go/Activities'])
+
+
+class UpgradeExpiryTest(_BaselineTest):
+
+    BASELINE_PLACES = \
+        [(u'http://popular.org/%d' % i, u'', 100, '2026-01-05 08:30:00')
+         for i in range(600)] + \
+        [(u'http://rare.org/%d' % i, u'', 0, '2026-01-05 08:30:00')
+         for i in range(600)]
+
+    def test_expiry_waits_for_frecency(self):
+        self._store.MAX_PLACES = 600
+        self._store.start_expiry()
+        _run_main_loop(lambda: self._store._expiry is None)
+
+        self.assertEqual(self._fetch('select count(*) from places '
+                                     'where uri like "http://popular.org/%"'),
+                         [(600,)])
+        self.assertEqual(self._fetch('select count(*) from archive.places '
+                                     'where uri like "http://rare.org/%"'),
+                         [(600,)])
+
+
+
+class ImportVisitsTest(_BaselineTest):
+
+    def test_imported_places_by_day(self):
+        self._backfill()
+        day = date(2026, 2, 1)
+        exported = StringIO.StringIO()
+        exported.write(json.dumps({
+            'uri': u'http://sugarlabs.org/', 'title': u'Sugar Labs',
+            'visits': 2, 'last_visit': _to_seconds('2026-02-01 10:00:00')}))
+        exported.write('\n')
+        exported.write(json.dumps({
+            'uri': u'http://activities.sugarlabs.org/', 'title': u'ASLO',
+            'visits': 1, 'last_visit': _to_seconds('2026-02-01 09:00:00')}))
+        exported.write('\n')
+        exported.seek(0)
+        self._store.import_places(exported)
+
+        self.assertEqual([place.uri for place in
+                          self._store.get_places_by_day(day)],
+                         [u'http://sugarlabs.org/',
+                          u'http://activities.sugarlabs.org/'])
+
+
+if __name__ == '__main__':
+    unittest.main()
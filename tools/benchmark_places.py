@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Benchmark the places store on synthetic histories.
+
+Run it from the activity directory, without Sugar or a display:
+
+    python tools/benchmark_places.py --sizes 1000,10000,100000
+
+Every size gets a new places.db in a temporary activity root, filled
+with generated places.  The generator is seeded, so the numbers of two
+commits can be compared line by line.
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import tempfile
+import optparse
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+_activity_root = None
+
+
+def _get_activity_root():
+    return _activity_root
+
+
+def _stub_sugar():
+    # places only needs the activity root from Sugar.
+    for name in ['sugar3', 'sugar3.activity', 'sugar3.activity.activity']:
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules['sugar3'].activity = sys.modules['sugar3.activity']
+    sys.modules['sugar3.activity'].activity = \
+        sys.modules['sugar3.activity.activity']
+    sys.modules['sugar3.activity.activity'].get_activity_root = \
+        _get_activity_root
+
+
+_stub_sugar()
+
+from gi.repository import GLib
+
+import places
+
+_LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+_TLDS = ['org', 'com', 'net', 'edu', 'org.uy', 'com.pe', 'co.uk']
+
+# What the URL entry searches first, matching most of the places.
+_FIRST_KEYS = ['h', 'ht', 'http', 'w', 'ww', 'www']
+
+
+class _Generator(object):
+    """Make up places with skewed, web-like distributions.
+
+    A few hosts and words are very common and most are rare, the
+    visits of a place follow a power law and the last visits are
+    spread over twice the expiry period.
+    """
+
+    def __init__(self, size, seed):
+        self._random = random.Random(seed)
+        self._words = [self._make_word() for i in range(5000)]
+        self._hosts = [self._make_host() for i in range(
+            max(20, int(size ** 0.6)))]
+        self._now = datetime.now()
+
+    def _make_word(self):
+        length = self._random.randint(2, 10)
+        return ''.join(self._random.choice(_LETTERS)
+                       for i in range(length))
+
+    def _make_host(self):
+        labels = [self._make_word()]
+        if self._random.random() < 0.3:
+            labels.insert(0, self._random.choice(['www', 'en', 'es', 'm']))
+        labels.append(self._random.choice(_TLDS))
+        return '.'.join(labels)
+
+    def _pick(self, items):
+        # Power law: the first items are picked most of the time.
+        index = int(self._random.paretovariate(0.8)) - 1
+        return items[index % len(items)]
+
+    def make_place(self, number):
+        path = '/'.join(self._pick(self._words)
+                        for i in range(self._random.randint(0, 4)))
+        uri = 'http://%s/%s' % (self._pick(self._hosts), path)
+        if self._random.random() < 0.3:
+            uri += '?id=%d' % number
+        else:
+            uri += '/%d' % number
+
+        title = ' '.join(self._pick(self._words).capitalize()
+                         for i in range(self._random.randint(1, 8)))
+        days = places.SqliteStore.EXPIRE_DAYS * 2
+        last_visit = self._now - timedelta(
+            seconds=self._random.randint(0, days * 24 * 60 * 60))
+
+        return places.Place(uri, title,
+                            visits=int(self._random.paretovariate(1.5)),
+                            last_visit=last_visit)
+
+    def make_text(self):
+        return ' '.join(self._pick(self._words)
+                        for i in range(self._random.randint(200, 3000)))
+
+    def make_query(self):
+        word = self._pick(self._words)
+        return word[:self._random.randint(1, len(word))]
+
+
+def _to_json_lines(generator, size):
+    lines = StringIO()
+    for number in range(size):
+        place = generator.make_place(number)
+        lines.write(json.dumps({
+            'uri': place.uri,
+            'title': place.title,
+            'visits': place.visits,
+            'last_visit': str(place.last_visit)}))
+        lines.write('\n')
+    lines.seek(0)
+    return lines
+
+
+def _run_main_loop(done):
+    context = GLib.MainContext.default()
+    while not done():
+        context.iteration(True)
+
+
+def _timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def _wait_for_writes(store, new_places):
+    # lookup_place() returns once the queued writes are committed,
+    # also in WAL mode where a thread commits them.
+    store.lookup_place(new_places[-1].uri)
+
+
+def _get_file_size(path):
+    size = 0
+    for suffix in ['', '-wal']:
+        if os.path.exists(path + suffix):
+            size += os.path.getsize(path + suffix)
+    return size
+
+
+def _report(size, name, value, unit):
+    print '%-8d %-24s %12.3f %s' % (size, name, value, unit)
+    sys.stdout.flush()
+
+
+def _report_latency(size, name, timings):
+    timings.sort()
+    _report(size, name + ' mean', sum(timings) / len(timings) * 1000, 'ms')
+    _report(size, name + ' p95', timings[int(len(timings) * 0.95)] * 1000,
+            'ms')
+
+
+def benchmark(size, options):
+    generator = _Generator(size, options.seed)
+
+    store = places.SqliteStore(wal=options.wal, fuzzy=options.fuzzy)
+    # Run the background work back to back, the benchmark measures
+    # its cost and not the pauses left for the user interface.
+    store.BACKFILL_INTERVAL = 0
+    store.EXPIRE_INTERVAL = 0
+    store.MAINTENANCE_INTERVAL = 0
+    store.MAINTENANCE_MAX_LOAD = float('inf')
+
+    lines = _to_json_lines(generator, size)
+    duration = _timed(store.import_places, lines)
+    _report(size, 'import', size / duration, 'places/s')
+
+    duration = _timed(_run_main_loop, lambda: store._backfill_sid is None
+                      and store._trigram_sid is None)
+    _report(size, 'backfill', duration, 's')
+    _report(size, 'file size', _get_file_size(store._db_path) / 1e6, 'MB')
+
+    timings = [_timed(store.search, generator.make_query())
+               for i in range(options.queries)]
+    _report_latency(size, 'search', timings)
+
+    timings = [_timed(store.search, text) for text in _FIRST_KEYS
+               for i in range(max(1, options.queries / len(_FIRST_KEYS)))]
+    _report_latency(size, 'search first keys', timings)
+
+    uris = [place.uri for rowid, place in store.get_places(
+        generator._random.randint(0, max(0, size - options.queries)),
+        options.queries)]
+    timings = [_timed(store.lookup_place, uri) for uri in uris]
+    _report_latency(size, 'lookup_place', timings)
+
+    new_places = [generator.make_place(size + i)
+                  for i in range(options.writes)]
+    start = time.time()
+    for place in new_places:
+        store.add_place(place)
+    _wait_for_writes(store, new_places)
+    _report(size, 'add_place', options.writes / (time.time() - start),
+            'places/s')
+
+    start = time.time()
+    for place in new_places:
+        place.visits += 1
+        store.update_place(place)
+    _wait_for_writes(store, new_places)
+    _report(size, 'update_place', options.writes / (time.time() - start),
+            'places/s')
+
+    start = time.time()
+    for place in new_places:
+        store.record_visit(place.uri)
+    _wait_for_writes(store, new_places)
+    _report(size, 'record_visit', options.writes / (time.time() - start),
+            'visits/s')
+
+    store.start_expiry()
+    _run_main_loop(lambda: store.get_expiry_stats() is not None)
+    deleted, duration, elapsed = store.get_expiry_stats()
+    _report(size, 'expiry places', deleted, 'places')
+    _report(size, 'expiry sql', duration, 's')
+    _report(size, 'expiry elapsed', elapsed, 's')
+    _report(size, 'file size', _get_file_size(store._db_path) / 1e6, 'MB')
+
+    store.start_maintenance()
+    duration = _timed(_run_main_loop, lambda: store._maintenance is None)
+    _report(size, 'maintenance', duration, 's')
+    _report(size, 'file size', _get_file_size(store._db_path) / 1e6, 'MB')
+
+    store.close()
+
+
+def benchmark_pages(size, options):
+    # Only the page benchmark needs it.
+    import pageindex
+
+    generator = _Generator(size, options.seed)
+    index = pageindex.PageIndex()
+
+    start = time.time()
+    for number in range(size):
+        index.add_page(generator.make_place(number).uri,
+                       generator.make_text())
+    index.flush()
+    _report(size, 'page index', size / (time.time() - start), 'pages/s')
+    _report(size, 'page index size', _get_file_size(index._db_path) / 1e6,
+            'MB')
+
+    timings = [_timed(index.search, generator.make_query())
+               for i in range(options.queries)]
+    _report_latency(size, 'page search', timings)
+
+    index.close()
+
+
+def main():
+    global _activity_root
+
+    parser = optparse.OptionParser()
+    parser.add_option('--sizes', default='1000,10000,100000',
+                      help='comma separated numbers of places')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--queries', type='int', default=200,
+                      help='searches and lookups per size')
+    parser.add_option('--writes', type='int', default=1000,
+                      help='places added, updated and visited per size')
+    parser.add_option('--wal', action='store_true', default=False,
+                      help='run places.db in WAL mode')
+    parser.add_option('--fuzzy', action='store_true', default=False,
+                      help='keep the trigram index for fuzzy searches')
+    parser.add_option('--pages', type='int', default=0,
+                      help='pages of text to index, like a month of '
+                      'browsing')
+    options, args = parser.parse_args()
+
+    print 'SQLite %s, wal=%s, fuzzy=%s' % (places.sqlite3.sqlite_version,
+                                           options.wal, options.fuzzy)
+
+    for size in [int(size) for size in options.sizes.split(',')]:
+        _activity_root = tempfile.mkdtemp(prefix='benchmark-places-')
+        os.mkdir(os.path.join(_activity_root, 'data'))
+        try:
+            benchmark(size, options)
+        finally:
+            shutil.rmtree(_activity_root)
+
+    if options.pages:
+        _activity_root = tempfile.mkdtemp(prefix='benchmark-pages-')
+        os.mkdir(os.path.join(_activity_root, 'data'))
+        try:
+            benchmark_pages(options.pages, options)
+        finally:
+            shutil.rmtree(_activity_root)
+
+
+if __name__ == '__main__':
+    main()
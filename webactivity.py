@@ -124,6 +124,8 @@ from webtoolbar import PrimaryToolbar
 from edittoolbar import EditToolbar
 from viewtoolbar import ViewToolbar
 import downloadmanager
+import globalhistory
+import pageindex
 
 # TODO: make the registration clearer SL #3087
 
@@ -242,6 +244,24 @@ class WebActivity(activity.Activity):
         # http://bugs.sugarlabs.org/ticket/3973
         self._cleanup_temp_files()
 
+        # Drop the text of the pages expired from the history.
+        if pageindex.get_page_index() is not None:
+            globalhistory.get_global_history().connect(
+                'places-expired', self.__places_expired_cb)
+
+        # Expire old history and maintain places.db once the activity
+        # is up and running.
+        GObject.idle_add(self.__expire_history_cb)
+
+    def __places_expired_cb(self, history, uris):
+        pageindex.get_page_index().remove_pages(uris)
+
+    def __expire_history_cb(self):
+        global_history = globalhistory.get_global_history()
+        global_history.expire()
+        global_history.maintain()
+        return False
+
     def _cleanup_temp_files(self):
         """Removes temporary files generated by Download Manager that
         were cancelled by the user or failed for any reason.
@@ -427,6 +447,8 @@ class WebActivity(activity.Activity):
             self._tabbed_view.props.current_browser.grab_focus()
 
     def write_file(self, file_path):
+        globalhistory.get_global_history().flush()
+
         if not self.metadata['mime_type']:
             self.metadata['mime_type'] = 'text/plain'
 
@@ -583,6 +605,8 @@ class WebActivity(activity.Activity):
 
         browser = self._tabbed_view.props.current_browser
         ui_uri = browser.get_uri()
+        globalhistory.get_global_history().add_bookmark(
+            ui_uri, browser.props.title)
 
         for link in self.model.data['shared_links']:
             if link['hash'] == sha1(ui_uri).hexdigest():
@@ -622,6 +646,11 @@ class WebActivity(activity.Activity):
 
     def _link_removed_cb(self, button, hash):
         ''' remove a link from tray and delete it in the model '''
+        for link in self.model.data['shared_links']:
+            if link['hash'] == hash:
+                globalhistory.get_global_history().remove_bookmark(
+                    link['url'])
+                break
         self.model.remove_link(hash)
         self._tray.remove_item(button)
         if len(self._tray.get_children()) == 0:
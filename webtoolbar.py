@@ -38,10 +38,11 @@ from sugar3.datastore import datastore
 from sugar3.activity import activity
 from sugar3.graphics.alert import Alert
 from sugar3.graphics.icon import Icon
+from sugar3 import profile
 
 import tempfile
 import filepicker
-import places
+import globalhistory
 from browser import Browser
 from browser import HOME_PAGE_GCONF_KEY, LIBRARY_PATH
 
@@ -159,16 +160,18 @@ class WebEntry(iconentry.IconEntry):
 
         return view
 
-    def _search_update(self):
+    def _search_update(self, matches):
         list_store = Gtk.ListStore(str, str)
 
-        search_text = self.props.text.decode('utf-8')
-        for place in places.get_store().search(search_text):
+        for place in matches:
             list_store.append([place.uri, place.title])
 
         self._search_view.set_model(list_store)
 
-        return len(list_store) > 0
+        if len(list_store) > 0:
+            self._search_popup()
+        else:
+            self._search_popdown()
 
     def _search_popup(self):
         miss, window_x, window_y = self.props.window.get_origin()
@@ -187,6 +190,7 @@ class WebEntry(iconentry.IconEntry):
         self._search_window.show()
 
     def _search_popdown(self):
+        globalhistory.get_global_history().cancel_search()
         self._search_window.hide()
 
     def __focus_in_event_cb(self, entry, event):
@@ -250,10 +254,16 @@ class WebEntry(iconentry.IconEntry):
     def __changed_cb(self, entry):
         self._address = self.props.text
 
-        if not self.props.text or not self._search_update():
+        if not self.props.text:
             self._search_popdown()
-        else:
-            self._search_popup()
+            return
+
+        search_text = self.props.text.decode('utf-8')
+        globalhistory.get_global_history().search(search_text,
+                                                  self.__search_cb)
+
+    def __search_cb(self, matches):
+        self._search_update(matches)
 
 
 class UrlToolbar(Gtk.EventBox):
@@ -398,6 +408,9 @@ class PrimaryToolbar(ToolbarBase):
         self._link_add.connect('clicked', self._link_add_clicked_cb)
         toolbar.insert(self._link_add, -1)
         self._link_add.show()
+        self._link_add_bookmarked = False
+        globalhistory.get_global_history().connect(
+            'bookmark-changed', self.__bookmark_changed_cb)
 
         self._toolbar_separator = Gtk.SeparatorToolItem()
         self._toolbar_separator.props.draw = False
@@ -539,6 +552,24 @@ class PrimaryToolbar(ToolbarBase):
             self.entry.props.address = ''
         else:
             self.entry.props.address = uri
+        self._update_link_add(uri)
+
+    def _update_link_add(self, uri):
+        # Color the star of bookmarked pages, checked on every
+        # navigation, is_bookmarked() doesn't touch the database.
+        bookmarked = uri is not None and \
+            globalhistory.get_global_history().is_bookmarked(uri)
+        if bookmarked == self._link_add_bookmarked:
+            return
+        self._link_add_bookmarked = bookmarked
+
+        if bookmarked:
+            icon = Icon(icon_name='emblem-favorite',
+                        xo_color=profile.get_color())
+        else:
+            icon = Icon(icon_name='emblem-favorite')
+        self._link_add.set_icon_widget(icon)
+        icon.show()
 
     def __changed_cb(self, iconentry):
         # The WebEntry can be changed when we click on a link, then we
@@ -595,6 +626,7 @@ class PrimaryToolbar(ToolbarBase):
     def _entry_activate_cb(self, entry):
         url = entry.props.text
         effective_url = self._tabbed_view.normalize_or_autosearch_url(url)
+        self._browser.typed_navigation = True
         self._browser.load_uri(effective_url)
         self._browser.loading_uri = effective_url
         self.entry.props.address = effective_url
@@ -697,6 +729,12 @@ class PrimaryToolbar(ToolbarBase):
     def _link_add_clicked_cb(self, button):
         self.emit('add-link')
 
+    def __bookmark_changed_cb(self, history, bookmarks):
+        # Also when the link is removed from the tray, or bookmarked
+        # by another Browse instance.
+        if self._browser is not None:
+            self._update_link_add(self._browser.get_uri())
+
     def save_as_pdf(self, widget):
         tmp_dir = os.path.join(self._activity.get_activity_root(), 'tmp')
         fd, file_path = tempfile.mkstemp(dir=tmp_dir)